@@ -0,0 +1,304 @@
+#name:		  lasbenchmark
+#created:	   October 2026
+#description:   benchmark the pylasfile reader and writer on synthetic files for every las version and point format
+#notes:		 run 'python lasbenchmark.py -n 100000 1000000 -o new.json -c old.json' to benchmark two sizes, save the results and compare them with an earlier run.
+#			   'python lasbenchmark.py -c old.json new.json' compares two saved runs, and 'python lasbenchmark.py --decoders' times the bulk decoder against the old per record loop
+
+import os.path
+import sys
+import json
+import struct
+import tempfile
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+try:
+	import resource
+except ImportError:
+	# not available on windows
+	resource = None
+
+import pylasfile
+
+# the README quotes 2.9 million points in 2.4 seconds, ie about a million points per second
+READMEPOINTSPERSECOND = 1000000
+
+# the las versions and the point formats each one supports
+POINTFORMATS = {1.2: [0, 1, 2, 3], 1.4: list(range(11))}
+OPERATIONS = ["write", "read", "decode", "roundtrip"]
+RESULTSVERSION = 1
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the pylasfile reader and writer on synthetic las 1.2 and 1.4 files for point formats 0-10.')
+	parser.add_argument('-n', dest='sizes', type=int, nargs='+', default=[10000, 100000], help='numbers of points to write into the synthetic files. [Default: 10000 100000]')
+	parser.add_argument('-r', dest='repeats', type=int, default=3, help='number of times to repeat each timing, the fastest is reported. [Default: 3]')
+	parser.add_argument('-v', dest='versions', type=float, nargs='+', default=[1.2, 1.4], help='las versions to benchmark. [Default: 1.2 1.4]')
+	parser.add_argument('-f', dest='formats', type=int, nargs='+', default=list(range(11)), help='point formats to benchmark, formats a version does not support are skipped. [Default: 0-10]')
+	parser.add_argument('-o', dest='outfilename', default=None, help='write the results to this json file.')
+	parser.add_argument('-c', dest='compare', nargs='+', default=None, help='compare the results with this baseline json file, or compare two json files without running the benchmark.')
+	parser.add_argument('-t', dest='threshold', type=float, default=0.1, help='report a regression when the throughput drops by more than this fraction. [Default: 0.1]')
+	parser.add_argument('-l', dest='label', default="", help='a label to store with the results, eg the version or commit being benchmarked.')
+	parser.add_argument('--decoders', action='store_true', help='time the bulk decoders against the original per record loop instead.')
+	args = parser.parse_args()
+
+	if args.decoders:
+		benchmarkdecode(args.sizes[-1], args.repeats)
+		return
+
+	if args.compare is not None and len(args.compare) == 2:
+		results = loadresults(args.compare[1])
+	else:
+		results = benchmarksuite(args.sizes, args.versions, args.formats, args.repeats, args.label)
+		if args.outfilename is not None:
+			saveresults(results, args.outfilename)
+
+	if args.compare is not None:
+		regressions = compareresults(loadresults(args.compare[0]), results, args.threshold)
+		if regressions > 0:
+			# a non zero exit status lets a build script fail on a regression
+			sys.exit(1)
+
+###############################################################################
+def benchmarksuite(sizes, versions, formats, repeats, label=""):
+	'''
+	time writing, reading, decoding and round tripping a synthetic file for every combination of size, las version and point format, print a table and return the results as a dictionary which can be saved as json.
+	the peak memory of each operation is measured in a separate untimed run, as tracemalloc slows python down
+	'''
+	results = {"version": RESULTSVERSION, "label": label, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(), "results": []}
+	print ("%-8s %-7s %10s %-10s %12s %14s %14s" % ("version", "format", "points", "operation", "seconds", "pts/sec", "peak bytes"))
+	with tempfile.TemporaryDirectory() as folder:
+		for numpoints in sizes:
+			points = createsyntheticpoints(numpoints)
+			for lasformat in versions:
+				for pointformat in formats:
+					if pointformat not in POINTFORMATS.get(lasformat, []):
+						continue
+					filename = os.path.join(folder, "v%s_format%d_%d.las" % (lasformat, pointformat, numpoints))
+					copyname = os.path.join(folder, "copy.las")
+					operations = {
+						"write": lambda: writesyntheticfile(filename, lasformat, pointformat, points),
+						"read": lambda: readbytes(filename),
+						"decode": lambda: decodepoints(filename),
+						"roundtrip": lambda: roundtrip(filename, copyname),
+					}
+					for operation in OPERATIONS:
+						seconds = timeit(operations[operation], repeats)
+						peak = peakmemory(operations[operation])
+						results["results"].append({"lasformat": str(lasformat), "pointformat": pointformat, "numpoints": numpoints, "operation": operation, "seconds": seconds, "pointspersecond": numpoints / seconds, "peakbytes": peak})
+						print ("%-8s %-7d %10d %-10s %12.4f %14.0f %14d" % (lasformat, pointformat, numpoints, operation, seconds, numpoints / seconds, peak))
+	if resource is not None:
+		# ru_maxrss is in kilobytes on linux and bytes on mac os
+		results["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return results
+
+def createsyntheticpoints(numpoints, seed=1):
+	'''
+	return a laspoints with random points in a 1km square.  the same seed gives the same points, so runs can be compared
+	'''
+	rand = random.Random(seed)
+	points = pylasfile.laspoints()
+	for i in range(numpoints):
+		points.x.append(rand.uniform(300000, 301000))
+		points.y.append(rand.uniform(6000000, 6001000))
+		points.z.append(rand.uniform(0, 100))
+		points.intensity.append(rand.randint(0, 65535))
+		points.returnnumber.append(rand.randint(1, 5))
+		points.numberreturns.append(5)
+		points.classification.append(rand.randint(0, 31))
+		points.gpstime.append(i * 0.00001)
+		points.red.append(rand.randint(0, 65535))
+		points.green.append(rand.randint(0, 65535))
+		points.blue.append(rand.randint(0, 65535))
+	return points
+
+def writesyntheticfile(filename, lasformat, pointformat, points):
+	'''
+	write the synthetic points to a las file in the requested version and point format
+	'''
+	writer = pylasfile.laswriter(filename, lasformat)
+	writer.writeVLR_WGS84()
+	writer.hdr.PointDataRecordFormat = pointformat
+	for name, typecode in pylasfile.pointattributes:
+		column = getattr(points, name)
+		if len(column) > 0:
+			setattr(writer, name, column[:])
+	writer.computebbox_offsets()
+	writer.writepoints()
+	writer.writeHeader()
+	writer.close()
+
+def readbytes(filename):
+	'''
+	read every point record as raw bytes, without decoding them
+	'''
+	r = pylasfile.lasreader(filename)
+	r.readhdr()
+	r.seekPointRecordStart()
+	data = r.readpointbytes(r.hdr.Numberofpointrecords)
+	r.close()
+	return data
+
+def decodepoints(filename):
+	'''
+	read and decode every attribute of every point into the reader's columns
+	'''
+	r = pylasfile.lasreader(filename)
+	r.readhdr()
+	r.seekPointRecordStart()
+	r.readpoints(r.hdr.Numberofpointrecords)
+	r.close()
+	return r
+
+def roundtrip(filename, outfilename):
+	'''
+	decode a file into columns and write them to a new file with the same version and point format
+	'''
+	r = decodepoints(filename)
+	writesyntheticfile(outfilename, r.hdr.lasformat, r.hdr.PointDataRecordFormat, r)
+
+def peakmemory(func):
+	'''
+	return the peak number of bytes python allocated while running func
+	'''
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def saveresults(results, filename):
+	'''
+	write the results of a benchmark run to a json file
+	'''
+	with open(filename, "w") as f:
+		json.dump(results, f, indent=1)
+
+def loadresults(filename):
+	'''
+	read the results of a benchmark run from a json file
+	'''
+	with open(filename) as f:
+		results = json.load(f)
+	if results.get("version") != RESULTSVERSION:
+		raise ValueError("%s is not a version %d benchmark results file" % (filename, RESULTSVERSION))
+	return results
+
+def compareresults(baseline, current, threshold=0.1):
+	'''
+	print the throughput and peak memory of every benchmark in current relative to the same benchmark in baseline, and return the number whose throughput dropped by more than threshold
+	'''
+	def key(result):
+		return (result["lasformat"], result["pointformat"], result["numpoints"], result["operation"])
+	before = {key(result): result for result in baseline["results"]}
+	print ("")
+	print ("comparing '%s' (%s) with baseline '%s' (%s)" % (current.get("label", ""), current.get("created", ""), baseline.get("label", ""), baseline.get("created", "")))
+	print ("%-8s %-7s %10s %-10s %14s %14s %10s %10s" % ("version", "format", "points", "operation", "base pts/sec", "pts/sec", "speed", "memory"))
+	regressions = 0
+	for result in current["results"]:
+		old = before.get(key(result))
+		if old is None:
+			continue
+		speed = result["pointspersecond"] / old["pointspersecond"]
+		memory = result["peakbytes"] / old["peakbytes"] if old["peakbytes"] > 0 else 1.0
+		flag = ""
+		if speed < 1.0 - threshold:
+			flag = " SLOWER"
+			regressions += 1
+		print ("%-8s %-7d %10d %-10s %14.0f %14.0f %9.2fx %9.2fx%s" % (result["lasformat"], result["pointformat"], result["numpoints"], result["operation"], old["pointspersecond"], result["pointspersecond"], speed, memory, flag))
+	print ("%d regressions of more than %.0f%%" % (regressions, threshold * 100))
+	return regressions
+
+###############################################################################
+def benchmarkdecode(numpoints, repeats):
+	'''
+	write a synthetic file in every point format, then time the bulk decoder against the original per record slice and unpack loop
+	'''
+	print ("%-8s %14s %14s %10s %12s %16s %16s" % ("format", "bulk pts/sec", "slice pts/sec", "speedup", "vs README", "z+class pts/sec", "columns pts/sec"))
+	with tempfile.TemporaryDirectory() as folder:
+		for pointformat in range(11):
+			filename = os.path.join(folder, "format%d.las" % (pointformat))
+			createsyntheticfile(filename, pointformat, numpoints)
+
+			r = pylasfile.lasreader(filename)
+			r.readhdr()
+
+			bulk = timeit(lambda: decodebulk(r), repeats)
+			legacy = timeit(lambda: decodelegacy(r), repeats)
+			fields = timeit(lambda: r.read_fields(["z", "classification"]), repeats)
+			columns = timeit(lambda: decodecolumns(r), repeats)
+			r.close()
+
+			bulkrate = numpoints / bulk
+			legacyrate = numpoints / legacy
+			print ("%-8d %14.0f %14.0f %9.1fx %11.1fx %16.0f %16.0f" % (pointformat, bulkrate, legacyrate, legacy / bulk, bulkrate / READMEPOINTSPERSECOND, numpoints / fields, numpoints / columns))
+
+def createsyntheticfile(filename, pointformat, numpoints):
+	'''
+	write a las v1.4 file with random points in the requested point format
+	'''
+	writer = pylasfile.laswriter(filename, 1.4)
+	writer.writeVLR_WGS84()
+	writer.hdr.PointDataRecordFormat = pointformat
+	for i in range(numpoints):
+		writer.x.append(random.uniform(300000, 301000))
+		writer.y.append(random.uniform(6000000, 6001000))
+		writer.z.append(random.uniform(0, 100))
+		writer.intensity.append(random.randint(0, 65535))
+		writer.returnnumber.append(random.randint(1, 5))
+		writer.numberreturns.append(5)
+		writer.classification.append(random.randint(0, 31))
+		writer.gpstime.append(i * 0.00001)
+	writer.computebbox_offsets()
+	writer.writepoints()
+	writer.writeHeader()
+	writer.close()
+
+def decodebulk(r):
+	'''
+	decode every record with the bulk decoder
+	'''
+	r.seekPointRecordStart()
+	return r.readpointrecords(r.hdr.Numberofpointrecords)
+
+def decodecolumns(r):
+	'''
+	decode every attribute, including the bit fields, into the reader's arrays
+	'''
+	r.clearpoints()
+	r.seekPointRecordStart()
+	r.readpoints(r.hdr.Numberofpointrecords)
+
+def decodelegacy(r):
+	'''
+	decode every record the way readpointrecords used to, by slicing each record and unpacking it with the format string
+	'''
+	fmt, fmtlen = r.supportedformats[r.hdr.PointDataRecordFormat]
+	r.seekPointRecordStart()
+	data = r.fileptr.read(fmtlen * r.hdr.Numberofpointrecords)
+	result = []
+	i = 0
+	for _ in range(r.hdr.Numberofpointrecords):
+		j = i + fmtlen
+		result.append(struct.unpack(fmt, data[i:j]))
+		i = j
+	return result
+
+def timeit(func, repeats):
+	'''
+	return the fastest duration in seconds from several runs of func
+	'''
+	best = None
+	for _ in range(repeats):
+		start_time = time.perf_counter()
+		func()
+		duration = time.perf_counter() - start_time
+		if best is None or duration < best:
+			best = duration
+	return best
+
+###############################################################################
+if __name__ == "__main__":
+	main()
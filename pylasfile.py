@@ -18,12 +18,30 @@
 # The public header block contains generic data such as point numbers and point data bounds.
 
 import os.path
+import sys
 import struct
+import mmap
 import pprint
 import time
 import datetime
 import math
 import random
+import array
+import collections
+import heapq
+import tempfile
+import bisect
+import json
+import itertools
+import zlib
+import concurrent.futures
+from multiprocessing import shared_memory
+
+# lazrs is only needed to read and write compressed LAZ files
+try:
+	import lazrs
+except ImportError:
+	lazrs = None
 
 def main():
 
@@ -67,70 +85,608 @@ def testwriter():
 
 	# testreader(outFileName)
 
+# compiled point record structs keyed by (point format, record length).  see lashdr.getpointstruct()
+pointstructcache = {}
+
+# the point attributes held by laspoints, and the array typecode used to store each one.
+# the typecodes are the smallest which hold every value the las point formats allow
+pointattributes = [
+	("x", 'd'),
+	("y", 'd'),
+	("z", 'd'),
+	("intensity", 'H'),
+	("returnnumber", 'B'),
+	("numberreturns", 'B'),
+	("scandirectionflag", 'B'),
+	("edgeflightline", 'B'),
+	("classification", 'B'),
+	("scananglerank", 'b'),
+	("userdata", 'B'),
+	("pointsourceid", 'H'),
+	("gpstime", 'd'),
+	("red", 'H'),
+	("green", 'H'),
+	("blue", 'H'),
+	("wavepacketdescriptorindex", 'B'),
+	("byteoffsettowaveformdata", 'Q'),
+	("waveformpacketsize", 'I'),
+	("returnpointwaveformlocation", 'f'),
+	("wavex", 'f'),
+	("wavey", 'f'),
+	("wavez", 'f'),
+	("nir", 'H'),
+	("classificationflags", 'B'),
+	("scannerchannel", 'B'),
+	("scanangle", 'h'),
+	]
+
+# struct format characters used in the point formats, mapped to the array typecode of the same size
+structtypecodes = {'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'l': 'i', 'L': 'I', 'q': 'q', 'Q': 'Q', 'f': 'f', 'd': 'd'}
+
+def extractfield(data, recordlength, offset, structchar):
+	'''
+	extract a single field from every record in a block of raw point records, and return it as a typed array.
+	rather than unpacking each record, every byte of the field is gathered with one strided slice, so the work is done in C and the other fields are never touched
+	'''
+	size = struct.calcsize('<' + structchar)
+	count = len(data) // recordlength
+	buf = bytearray(count * size)
+	for k in range(size):
+		buf[k::size] = data[offset + k:count * recordlength:recordlength]
+	column = array.array(structtypecodes[structchar])
+	column.frombytes(buf)
+	# las files are little endian
+	if sys.byteorder == 'big':
+		column.byteswap()
+	return column
+
+# the bit fields packed into the flag bytes of the point formats, as (attribute, first bit, number of bits)
+legacyflagfields = [("returnnumber", 0, 3), ("numberreturns", 3, 3), ("scandirectionflag", 6, 1), ("edgeflightline", 7, 1)]
+extendedflag1fields = [("returnnumber", 0, 4), ("numberreturns", 4, 4)]
+extendedflag2fields = [("classificationflags", 0, 4), ("scannerchannel", 4, 2), ("scandirectionflag", 6, 1), ("edgeflightline", 7, 1)]
+# in formats 0-5 the classification byte also carries the synthetic, key-point and withheld flags.  these are the first 3 classification flags of v1.4
+legacyclassificationfields = [("classification", 0, 5), ("classificationflags", 5, 3)]
+
+# 256 entry lookup tables for packing and unpacking bit fields, keyed by (first bit, number of bits)
+bitfieldencodetables = {}
+bitfielddecodetables = {}
+for shift, width in set([(f[1], f[2]) for f in legacyflagfields + extendedflag1fields + extendedflag2fields + legacyclassificationfields]):
+	mask = (1 << width) - 1
+	# value -> the value moved into its bits of the flag byte
+	bitfieldencodetables[(shift, width)] = bytes([((v & mask) << shift) & 0xff for v in range(256)])
+	# flag byte -> the value held in its bits
+	bitfielddecodetables[(shift, width)] = bytes([(v >> shift) & mask for v in range(256)])
+
+def columnbytes(column):
+	'''
+	return a column of small integers as one byte per value
+	'''
+	if isinstance(column, array.array) and column.itemsize == 1:
+		return column.tobytes()
+	return bytes(list(column))
+
+def packflags(points, fields, start, end):
+	'''
+	pack whole columns of bit field values into a flag byte per point in one step.
+	each column is moved into its bits with bytes.translate() and a lookup table, then the columns are combined with a single OR across all the points by treating them as one large integer.
+	fields is one of legacyflagfields, extendedflag1fields or extendedflag2fields
+	'''
+	count = end - start
+	packed = 0
+	for name, shift, width in fields:
+		column = columnbytes(getattr(points, name)[start:end])
+		packed |= int.from_bytes(column.translate(bitfieldencodetables[(shift, width)]), 'little')
+	return packed.to_bytes(count, 'little')
+
+def unpackflags(flagbytes, fields):
+	'''
+	the reverse of packflags.  unpack a flag byte per point into a dictionary of typed arrays, one per bit field, using a lookup table per field
+	'''
+	result = {}
+	for name, shift, width in fields:
+		result[name] = array.array('B', flagbytes.translate(bitfielddecodetables[(shift, width)]))
+	return result
+
+def decodepointfields(data, hdr, names, scaled=True):
+	'''
+	decode the named attributes from a block of raw point records in the point format of the header, and return a dictionary of typed arrays.
+	plain fields are extracted by strided access at their byte offset.  bit field attributes such as returnnumber are pulled out of their flag byte with a lookup table, and each flag byte is only extracted once.
+	x, y and z are scaled into real world values unless scaled is False
+	'''
+	layout = hdr.getpointfieldlayout()
+	bitfields = hdr.getpointbitfields()
+	for name in names:
+		if name not in layout and name not in bitfields:
+			raise ValueError("field %s is not in point format %d" % (name, hdr.PointDataRecordFormat))
+	recordlength = hdr.getpointstruct().size
+	count = len(data) // recordlength
+
+	result = {}
+	flagbytes = {}
+	for name in names:
+		if name in bitfields:
+			field, shift, width = bitfields[name]
+			if field not in flagbytes:
+				offset = layout[field][0]
+				flagbytes[field] = bytes(data[offset:count * recordlength:recordlength])
+			result[name] = array.array('B', flagbytes[field].translate(bitfielddecodetables[(shift, width)]))
+			continue
+		offset, structchar = layout[name]
+		column = extractfield(data, recordlength, offset, structchar)
+		if scaled and name == "x":
+			column = scalecolumn(column, hdr.Xscalefactor, hdr.Xoffset)
+		elif scaled and name == "y":
+			column = scalecolumn(column, hdr.Yscalefactor, hdr.Yoffset)
+		elif scaled and name == "z":
+			column = scalecolumn(column, hdr.Zscalefactor, hdr.Zoffset)
+		result[name] = column
+	return result
+
+def matchrecords(data, hdr, classification=None, returnnumber=None, pointsourceid=None, gpstime=None, lastreturn=False):
+	'''
+	test a block of raw point records against simple predicates and return a mask, with one byte per record which is 1 if the record matches them all.
+	the predicates are tested on the raw bytes at each field's offset.  the byte sized fields use a 256 entry lookup table, so nothing is unpacked for them.
+	classification, returnnumber and pointsourceid are a value or a list of values.  gpstime is a (start, end) range, inclusive.  lastreturn matches records whose return number is their number of returns
+	'''
+	layout = hdr.getpointfieldlayout()
+	bitfields = hdr.getpointbitfields()
+	recordlength = hdr.getpointstruct().size
+	count = len(data) // recordlength
+	masks = []
+
+	def bytefieldmask(name, test):
+		# build a table which maps every possible value of the byte holding the field onto 1 if it passes the test, then translate the column of bytes through it
+		if name in bitfields:
+			field, shift, width = bitfields[name]
+			decode = bitfielddecodetables[(shift, width)]
+			table = bytes([1 if test(decode[b]) else 0 for b in range(256)])
+		else:
+			field = name
+			table = bytes([1 if test(b) else 0 for b in range(256)])
+		offset = layout[field][0]
+		return bytes(data[offset:count * recordlength:recordlength]).translate(table)
+
+	if classification is not None:
+		wanted = set(classification) if isinstance(classification, (list, tuple, set)) else set([classification])
+		masks.append(bytefieldmask("classification", wanted.__contains__))
+	if returnnumber is not None:
+		wanted = set(returnnumber) if isinstance(returnnumber, (list, tuple, set)) else set([returnnumber])
+		masks.append(bytefieldmask("returnnumber", wanted.__contains__))
+	if lastreturn:
+		# the return number and number of returns share a byte, so one table tests both
+		field, rshift, rwidth = bitfields["returnnumber"]
+		field, nshift, nwidth = bitfields["numberreturns"]
+		rtable = bitfielddecodetables[(rshift, rwidth)]
+		ntable = bitfielddecodetables[(nshift, nwidth)]
+		table = bytes([1 if rtable[b] == ntable[b] else 0 for b in range(256)])
+		offset = layout[field][0]
+		masks.append(bytes(data[offset:count * recordlength:recordlength]).translate(table))
+	if pointsourceid is not None:
+		wanted = set(pointsourceid) if isinstance(pointsourceid, (list, tuple, set)) else set([pointsourceid])
+		offset, structchar = layout["pointsourceid"]
+		masks.append(bytes([1 if v in wanted else 0 for v in extractfield(data, recordlength, offset, structchar)]))
+	if gpstime is not None:
+		if "gpstime" not in layout:
+			raise ValueError("point format %d has no gps time" % (hdr.PointDataRecordFormat))
+		start, end = gpstime
+		offset, structchar = layout["gpstime"]
+		masks.append(bytes([1 if start <= v <= end else 0 for v in extractfield(data, recordlength, offset, structchar)]))
+
+	if len(masks) == 0:
+		return b"\x01" * count
+	# and the masks together as big integers, which is one operation however many records there are
+	mask = int.from_bytes(masks[0], "little")
+	for m in masks[1:]:
+		mask &= int.from_bytes(m, "little")
+	return mask.to_bytes(count, "little")
+
+def convertpointrecords(data, srchdr, dsthdr):
+	'''
+	convert a block of raw point records from the point format of one header to the point format of another, working on the record bytes so no value is ever scaled to a float.
+	fields of the same type are copied by strided slices.  the bit fields are decoded from the source one byte per record with lookup tables and packed into the destination flag bytes.
+	values which do not fit the destination are limited: return numbers above 7 become 7, classes above 31 become 1 (unclassified), and the overlap classification flag is dropped.  scan angles are converted between whole degrees and 0.006 degree steps.
+	fields the destination does not have are dropped, and fields the source does not have are zero
+	'''
+	srclayout = srchdr.getpointfieldlayout()
+	dstlayout = dsthdr.getpointfieldlayout()
+	srcbits = srchdr.getpointbitfields()
+	dstbits = dsthdr.getpointbitfields()
+	srclength = srchdr.getpointstruct().size
+	dstlength = dsthdr.getpointstruct().size
+	count = len(data) // srclength
+	out = bytearray(count * dstlength)
+	srcflagbytes = set([field for field, shift, width in srcbits.values()])
+	dstflagbytes = set([field for field, shift, width in dstbits.values()])
+
+	def sourcebytes(name):
+		# the value of a byte sized attribute of every source record, one byte each, or None if the source does not have it
+		if name in srcbits:
+			field, shift, width = srcbits[name]
+			offset = srclayout[field][0]
+			return bytes(data[offset:count * srclength:srclength]).translate(bitfielddecodetables[(shift, width)])
+		if name in srclayout and srclayout[name][1] in "Bb":
+			offset = srclayout[name][0]
+			return bytes(data[offset:count * srclength:srclength])
+		return None
+
+	# plain fields
+	for name, (offset, structchar) in dstlayout.items():
+		if name in dstflagbytes or name not in srclayout or name in srcflagbytes:
+			continue
+		srcoffset, srcchar = srclayout[name]
+		if srcchar == structchar:
+			for k in range(struct.calcsize('<' + structchar)):
+				out[offset + k::dstlength] = data[srcoffset + k:count * srclength:srclength]
+		elif name == "scanangle":
+			angles = extractfield(data, srclength, srcoffset, srcchar)
+			if structchar == 'h':
+				column = array.array('h', [round(v / 0.006) for v in angles])
+			else:
+				column = array.array('b', [max(-90, min(90, round(v * 0.006))) for v in angles])
+			if sys.byteorder == "big":
+				column.byteswap()
+			raw = column.tobytes()
+			for k in range(column.itemsize):
+				out[offset + k::dstlength] = raw[k::column.itemsize]
+
+	# the classification byte of formats 6-10 from the bit field of formats 0-5
+	if "classification" not in dstbits and "classification" in srcbits:
+		out[dstlayout["classification"][0]::dstlength] = sourcebytes("classification")
+
+	# the flag bytes
+	for field in dstflagbytes:
+		packed = 0
+		for name, (f, shift, width) in dstbits.items():
+			if f != field:
+				continue
+			column = sourcebytes(name)
+			if column is None:
+				continue
+			limit = (1 << width) - 1
+			if name == "classificationflags":
+				table = bytes([v & limit for v in range(256)])
+			elif name == "classification":
+				table = bytes([v if v <= limit else 1 for v in range(256)])
+			else:
+				table = bytes([min(v, limit) for v in range(256)])
+			packed |= int.from_bytes(column.translate(table).translate(bitfieldencodetables[(shift, width)]), "little")
+		out[dstlayout[field][0]::dstlength] = packed.to_bytes(count, "little")
+
+	# any extra bytes after the standard fields
+	srcstandard = srchdr.getsuportedpointformats()[srchdr.PointDataRecordFormat][1]
+	dststandard = dsthdr.getsuportedpointformats()[dsthdr.PointDataRecordFormat][1]
+	for k in range(min(srclength - srcstandard, dstlength - dststandard)):
+		out[dststandard + k::dstlength] = data[srcstandard + k:count * srclength:srclength]
+	return bytes(out)
+
+def scalecolumn(column, scale, offset):
+	'''
+	convert a column of raw integer coordinates into real world values
+	'''
+	return array.array('d', [(v * scale) + offset for v in column])
+
+def selectrecords(data, recordlength, indices):
+	'''
+	gather the raw point records at the given indices from a block of records into a new block, so only those records need decoding
+	'''
+	return b"".join([data[i * recordlength:(i + 1) * recordlength] for i in indices])
+
+def spreadbits(v):
+	'''
+	spread the low 32 bits of v out so there is a zero bit between each of them, ready for interleaving into a morton code
+	'''
+	v &= 0xffffffff
+	v = (v | (v << 16)) & 0x0000ffff0000ffff
+	v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+	v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+	v = (v | (v << 2)) & 0x3333333333333333
+	v = (v | (v << 1)) & 0x5555555555555555
+	return v
+
+def mortoncode(ix, iy):
+	'''
+	return the position of cell (ix, iy) along a morton (z order) curve, by interleaving the bits of the cell numbers
+	'''
+	return spreadbits(ix) | (spreadbits(iy) << 1)
+
+def hilbertcode(ix, iy, bits=16):
+	'''
+	return the position of cell (ix, iy) along a hilbert curve covering a grid of 2**bits by 2**bits cells
+	'''
+	n = 1 << bits
+	d = 0
+	s = n >> 1
+	while s > 0:
+		rx = 1 if ix & s else 0
+		ry = 1 if iy & s else 0
+		d += s * s * ((3 * rx) ^ ry)
+		# rotate the quadrant so the curve joins up
+		if ry == 0:
+			if rx == 1:
+				ix = n - 1 - ix
+				iy = n - 1 - iy
+			ix, iy = iy, ix
+		s >>= 1
+	return d
+
+def curvekeys(xs, ys, minx, miny, cellsize, curve="morton"):
+	'''
+	return the position of each point along a space filling curve ('morton' or 'hilbert').  the points are first snapped to a grid of cellsize cells starting at minx, miny.
+	the hilbert curve keeps better locality, the morton curve is much quicker to compute
+	'''
+	if curve == "morton":
+		return [mortoncode(int((x - minx) / cellsize), int((y - miny) / cellsize)) for x, y in zip(xs, ys)]
+	if curve == "hilbert":
+		return [hilbertcode(int((x - minx) / cellsize), int((y - miny) / cellsize)) for x, y in zip(xs, ys)]
+	raise ValueError("unknown space filling curve %s, use 'morton' or 'hilbert'" % (curve))
+
+def curvecellsize(minx, miny, maxx, maxy, curve="morton"):
+	'''
+	return a cell size which fits the bounding box inside the grid of the curve.  morton codes use 32 bits per axis, our hilbert curve 16
+	'''
+	bits = 32 if curve == "morton" else 16
+	cellsize = max(maxx - minx, maxy - miny) / ((1 << bits) - 1)
+	if cellsize <= 0:
+		return 1
+	return cellsize
+
 ###############################################################################
-class laswriter:
-	def __init__(self, filename, lasformat=1.4):
+class laspoints:
+	'''
+	columnar container for point data.  each attribute is held in a typed array.array rather than a list of python objects, so a value costs 1-8 bytes rather than 30 or more.
+	the arrays behave like lists, so you can append(), extend() and index them as normal
+	'''
+	def __init__(self):
+		self.clearpoints()
+
+	def __len__(self):
+		# a chunk read with only some fields decoded may not have x, so use the longest column
+		return max([len(getattr(self, name)) for name, typecode in pointattributes])
+
+	def clearpoints(self):
+		'''
+		create a new empty array for every point attribute
+		'''
+		for name, typecode in pointattributes:
+			setattr(self, name, array.array(typecode))
+
+	def appendrecords(self, records, hdr):
+		'''
+		append a list of decoded point records, as returned by lasreader.readpointrecords(), to the columns.
+		the coordinates are scaled into real world values using the scale and offset in the header, and the flag bytes are unpacked into their bit field attributes
+		'''
+		if len(records) == 0:
+			return
+		fields = hdr.getpointformatfields()[hdr.PointDataRecordFormat]
+		bitfields = hdr.getpointbitfields()
+		# transpose the records into columns in a single pass
+		columns = list(zip(*records))
+		self.x.extend(scalecolumn(columns[0], hdr.Xscalefactor, hdr.Xoffset))
+		self.y.extend(scalecolumn(columns[1], hdr.Yscalefactor, hdr.Yoffset))
+		self.z.extend(scalecolumn(columns[2], hdr.Zscalefactor, hdr.Zoffset))
+		for i in range(3, len(fields)):
+			# the flag bytes are unpacked with a lookup table per bit field
+			packed = [(name, shift, width) for name, (field, shift, width) in bitfields.items() if field == fields[i]]
+			if len(packed) > 0:
+				for name, column in unpackflags(bytes(columns[i]), packed).items():
+					getattr(self, name).extend(column)
+				continue
+			column = getattr(self, fields[i], None)
+			if column is not None:
+				column.extend(columns[i])
+
+	def appendpointbytes(self, data, hdr):
+		'''
+		decode a block of raw point records, as returned by lasreader.readpointbytes(), and append every attribute of the point format to the columns.
+		this is the fast path, the records are never unpacked into tuples.  see decodepointfields()
+		'''
+		for name, column in decodepointfields(data, hdr, hdr.getpointattributes()).items():
+			target = getattr(self, name)
+			if target.typecode == column.typecode:
+				target.extend(column)
+			else:
+				target.fromlist(column.tolist())
+
+	def spatialorder(self, curve="morton"):
+		'''
+		return the order of the points along a space filling curve ('morton' or 'hilbert') over their bounding box
+		'''
+		if len(self.x) == 0:
+			return []
+		minx, maxx = min(self.x), max(self.x)
+		miny, maxy = min(self.y), max(self.y)
+		keys = curvekeys(self.x, self.y, minx, miny, curvecellsize(minx, miny, maxx, maxy, curve), curve)
+		return sorted(range(len(keys)), key=keys.__getitem__)
+
+	def reorder(self, order):
+		'''
+		rearrange every populated attribute into the given order of point indices
+		'''
+		for name, typecode in pointattributes:
+			column = getattr(self, name)
+			if len(column) == len(order):
+				setattr(self, name, array.array(column.typecode, [column[i] for i in order]) if isinstance(column, array.array) else [column[i] for i in order])
+
+	def fixemptylists(self):
+		'''
+		fill any attribute the caller has not populated with a default value for every point.
+		raises ValueError if a populated attribute does not have one value per point, as the encoder would otherwise drop the points past the end of the shortest one
+		'''
+		for name, typecode in pointattributes:
+			if len(getattr(self, name)) not in (0, len(self.x)):
+				raise ValueError("there are %d x values but %d %s values" % (len(self.x), len(getattr(self, name)), name))
+		for name, typecode in pointattributes:
+			if len(getattr(self, name)) == 0:
+				if name == "returnnumber" or name == "numberreturns":
+					setattr(self, name, array.array(typecode, [1]) * len(self.x))
+				else:
+					setattr(self, name, array.array(typecode, [0]) * len(self.x))
+
+###############################################################################
+def isgeographiccrs(recordid, vlrdata):
+	'''
+	return True if a LASF_Projection VLR describes a geographic coordinate system, False if it describes a projected one, or None if we cannot tell.
+	record 2112 holds OGC WKT, where a geographic system starts with GEOGCS.  record 34735 holds the GeoTIFF key directory, where the GTModelTypeGeoKey (1024) is 2 for geographic
+	'''
+	if recordid == 2112:
+		wkt = bytes(vlrdata).lstrip().upper()
+		if wkt.startswith((b'PROJCS', b'PROJCRS')):
+			return False
+		if wkt.startswith((b'GEOGCS', b'GEOGCRS')):
+			return True
+		if wkt.startswith((b'COMPD_CS', b'COMPOUNDCRS')):
+			# a compound system is projected if its horizontal part is
+			return b'PROJCS' not in wkt and b'PROJCRS' not in wkt
+		return None
+	if recordid == 34735 and len(vlrdata) >= 8:
+		keys = struct.unpack_from("<%dH" % (len(vlrdata) // 2), vlrdata)
+		for i in range(4, min(len(keys) - 3, 4 + (keys[3] * 4)), 4):
+			keyid, location, count, value = keys[i:i + 4]
+			if keyid == 1024 and location == 0:
+				return value == 2
+	return None
+
+###############################################################################
+class lasstats:
+	'''
+	accumulate the header statistics of points a batch at a time: the point count, the bounding box, and the number of points by return.
+	each batch is visited once per attribute by the builtin min, max and Counter, which run in C, so this is much quicker than a python loop over the points
+	'''
+	def __init__(self):
+		self.pointcount = 0
+		self.minx = self.miny = self.minz = math.inf
+		self.maxx = self.maxy = self.maxz = -math.inf
+		# the number of points by return number 1-15.  index 0 is not used
+		self.returncounts = [0] * 16
+
+	def update(self, points):
+		'''
+		add a batch of points, such as a laspoints object
+		'''
+		count = len(points.x)
+		if count == 0:
+			return
+		self.pointcount += count
+		self.minx = min(self.minx, min(points.x))
+		self.maxx = max(self.maxx, max(points.x))
+		self.miny = min(self.miny, min(points.y))
+		self.maxy = max(self.maxy, max(points.y))
+		self.minz = min(self.minz, min(points.z))
+		self.maxz = max(self.maxz, max(points.z))
+		if len(points.returnnumber) != count:
+			# the return numbers default to 1 when they are not given.  see laspoints.fixemptylists()
+			self.returncounts[1] += count
+			return
+		for returnnumber, n in collections.Counter(points.returnnumber).items():
+			if 1 <= returnnumber <= 15:
+				self.returncounts[returnnumber] += n
+
+	def applybbox(self, hdr):
+		'''
+		set the bounding box in the header.  with no points the box is left at zero
+		'''
+		if self.pointcount == 0:
+			hdr.MinX = hdr.MinY = hdr.MinZ = hdr.MaxX = hdr.MaxY = hdr.MaxZ = 0
+			return
+		hdr.MinX, hdr.MinY, hdr.MinZ = self.minx, self.miny, self.minz
+		hdr.MaxX, hdr.MaxY, hdr.MaxZ = self.maxx, self.maxy, self.maxz
+
+	def applycounts(self, hdr):
+		'''
+		set the point counts in the header.  the legacy counts only cover formats 0-5, 5 returns and 32 bit point counts, otherwise they are zero
+		'''
+		hdr.Numberofpointrecords = self.pointcount
+		for i in range(1, 16):
+			setattr(hdr, "Numberofpointsbyreturn%d" % (i), self.returncounts[i])
+		legacy = hdr.PointDataRecordFormat <= 5 and self.pointcount < 2**32
+		hdr.LegacyNumberofpointrecords = self.pointcount if legacy else 0
+		for i in range(1, 6):
+			setattr(hdr, "LegacyNumberofpointsbyreturn%d" % (i), self.returncounts[i] if legacy else 0)
+
+###############################################################################
+class laswriter(laspoints):
+	def __init__(self, filename, lasformat=1.4, sortorder=None, compress=None, workers=None, variablechunks=False, geographic=None):
+		# write a LAZ file, compressed with LASzip.  by default we compress if the filename ends in .laz.  we check we can before opening, so we never truncate an existing file
+		if compress is None:
+			compress = os.path.splitext(filename)[1].lower() == ".laz"
+		if compress and lazrs is None:
+			raise ImportError("writing LAZ files needs the lazrs package.  pip install lazrs")
+
 		self.fileName = filename
 		self.fileptr = open(filename, 'wb+')
 		self.hdr = lashdr(lasformat)
+		self.hdr.compressed = compress
+		# true while the file is closed by suspend() to save a file handle
+		self.suspended = False
 
-		# the lists of all the data we will populate, then write into whatever format the user desires.  
-		# these could be numpy arrays, but that introduces a dependency, so we will leave them as lists
-		self.x = []
-		self.y = []
-		self.z = []
-		self.intensity = []
-		self.returnnumber = []
-		self.numberreturns = []
-		self.scandirectionflag = []
-		self.edgeflightline = []
-		self.classification = []
-		self.scananglerank = []
-		self.userdata = []
-		self.pointsourceid = []
-		self.gpstime = []
-		self.red = []
-		self.green = []
-		self.blue = []
-		self.wavepacketdescriptorindex = []
-		self.byteoffsettowaveformdata = []
-		self.waveformpacketsize = []
-		self.returnpointwaveformlocation = []
-		self.wavex = []
-		self.wavey = []
-		self.wavez = []
-		self.nir = []
-
-		self.classificationflags = []
-		self.scannerchannel = []
-		self.userdata = []
-		self.scanangle = []
+		# if set to 'morton' or 'hilbert' the points are reordered along that space filling curve before they are written, so points close in space are close in the file
+		self.sortorder = sortorder
+
+		# the arrays of all the data we will populate, then write into whatever format the user desires.
+		laspoints.__init__(self)
 
 		self.supportedformats = self.hdr.getsuportedpointformats()
 
+		# state for streaming points to disc a batch at a time with writebatch()
+		self.streaming = False
+		self.headerwritten = False
+		# true once writepoints() has written the points in one go
+		self.pointswritten = False
+		self.scaleoffsetset = False
+		# whether the coordinates are longitude and latitude, which sets the scale estimated by writebatch().  None means we look at the coordinate system VLR, see writeVLR()
+		self.geographic = geographic
+		self.encodebuffer = bytearray()
+
+		# the bounding box and point counts of the points written, for the header
+		self.stats = lasstats()
+
+		# the extended VLRs to write after the point records when the header is written
+		self.evlrs = []
+
+		# state for LAZ files.  encoded records wait in lazpending until there is a full chunk, then each chunk is compressed on its own, in a pool of processes
+		self.lazvlrdata = None
+		self.lazpending = bytearray()
+		self.lazfutures = collections.deque()
+		self.lazchunks = []
+		self.lazoffset = 0
+		self.lazend = 0
+		# variable size LAZ chunks let suspend() compress a part filled chunk, rather than hold it in memory
+		self.variablechunks = variablechunks
+		# the number of processes used to compress LAZ chunks, default is one per cpu
+		self.workers = workers if workers is not None else os.cpu_count()
+		self.pool = None
+
 	def writeVLR_WGS84(self):
 		'''
 		compose and write a standard variable length record for the WKY of WGS84 CRS
 		'''
 
-		# before we write, we need to set the file pointer to the end of the VLR section , which is directly after the header block
-		vlrl = self.getVLRTotalLength()
-		self.fileptr.seek(self.hdr.HeaderSize + vlrl, 0)
-
-		# now write out the vlr record
-		vlrReserved				   = 0
 		vlrUserid					 = b'LASF_Projection'
 		vlrrecordid				   = 2112
 		byte_str = 'OGC Coordinate System123456789'.encode('utf-8')
 		byte_str = byte_str[:32].decode('utf-8', 'ignore').encode('utf-8')
 		vlrDescription				= byte_str 
 		vlrdata = b'PROJCS["WGS 84 / UTM zone 55S",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.01745329251994328,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",147],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",10000000],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AUTHORITY["EPSG","32755"]]\x00'
-		vlrRecordLengthAfterHeader	= len(vlrdata)
+		self.writeVLR(vlrUserid, vlrrecordid, vlrDescription, vlrdata)
+
+	def writeVLR(self, userid, recordid, description, vlrdata):
+		'''
+		write a variable length record after the VLRs already in the file
+		'''
+		if self.streaming:
+			raise ValueError("VLRs must be written before the first batch of points")
+
+		# before we write, we need to set the file pointer to the end of the VLR section , which is directly after the header block
+		vlrl = self.getVLRTotalLength()
+		self.fileptr.seek(self.hdr.HeaderSize + vlrl, 0)
 
 		# now we have set the file pointer to the correct spot, write the record to disc
+		vlrReserved				   = 0
 		record_struct = struct.Struct(self.hdr.vlrhdr14fmt)
-		self.fileptr.write(record_struct.pack(vlrReserved, vlrUserid, vlrrecordid, vlrRecordLengthAfterHeader, vlrDescription))
+		self.fileptr.write(record_struct.pack(vlrReserved, userid, recordid, len(vlrdata), description))
 		self.fileptr.write(vlrdata)
+		if userid.rstrip(b'\0') == b'LASF_Projection' and self.geographic is None:
+			self.geographic = isgeographiccrs(recordid, vlrdata)
 
 		self.hdr.NumberofVariableLengthRecords += 1
 		
@@ -139,7 +695,7 @@ class laswriter:
 		VLRTotalLength = 0
 		# seek to the start of the vlrdata
 		currentPosition = self.fileptr.tell()
-		self.fileptr.seek(self.hdr.hdr14len, 0)
+		self.fileptr.seek(self.hdr.HeaderSize, 0)
 		for i in range (self.hdr.NumberofVariableLengthRecords):
 			data = self.fileptr.read(self.hdr.vlrhdr14len)
 			s = struct.unpack(self.hdr.vlrhdr14fmt, data)
@@ -163,18 +719,14 @@ class laswriter:
 		'''
 		compute the bounding box of all records in the list
 		'''
-		self.hdr.MaxX = max(self.x) 
-		self.hdr.MinX = min(self.x) 
-
-		self.hdr.MaxY = max(self.y) 
-		self.hdr.MinY = min(self.y)
-
-		self.hdr.MaxZ = max(self.z) 
-		self.hdr.MinZ = min(self.z) 
+		self.stats = lasstats()
+		self.stats.update(self)
+		self.stats.applybbox(self.hdr)
 
 		self.hdr.Xoffset = self.hdr.MinX 
 		self.hdr.Yoffset = self.hdr.MinY
 		self.hdr.Zoffset = self.hdr.MinZ
+		self.scaleoffsetset = True
 
 		digit2, afterDP2 = self.precision_and_scale(self.hdr.MaxX - self.hdr.MinX)
 		self.hdr.Xscalefactor = 10**-(8-digit2)
@@ -211,348 +763,343 @@ class laswriter:
 		listofones = [1] * n
 		return listofones
 
-	def fixemptylists(self):
-		if len(self.intensity) == 0: 
-			self.intensity = self.zerolistmaker(len(self.x))
-		if len(self.returnnumber) == 0:
-			self.returnnumber = self.onelistmaker(len(self.x))
-		if len(self.numberreturns) == 0: 
-			self.numberreturns = self.onelistmaker(len(self.x))
-		if len(self.scandirectionflag) == 0: 
-			self.scandirectionflag = self.zerolistmaker(len(self.x))
-		if len(self.edgeflightline) == 0: 
-			self.edgeflightline = self.zerolistmaker(len(self.x))
-		if len(self.classification) == 0: 
-			self.classification = self.zerolistmaker(len(self.x))
-		if len(self.scananglerank) == 0: 
-			self.scananglerank = self.zerolistmaker(len(self.x))
-		if len(self.userdata) == 0: 
-			self.userdata = self.zerolistmaker(len(self.x))
-		if len(self.pointsourceid) == 0: 
-			self.pointsourceid = self.zerolistmaker(len(self.x))
-		if len(self.gpstime) == 0: 
-			self.gpstime = self.zerolistmaker(len(self.x))
-		if len(self.red) == 0: 
-			self.red = self.zerolistmaker(len(self.x))
-		if len(self.green) == 0: 
-			self.green = self.zerolistmaker(len(self.x))
-		if len(self.blue) == 0: 
-			self.blue = self.zerolistmaker(len(self.x))
-		if len(self.wavepacketdescriptorindex) == 0: 
-			self.wavepacketdescriptorindex = self.zerolistmaker(len(self.x))
-		if len(self.byteoffsettowaveformdata) == 0: 
-			self.byteoffsettowaveformdata = self.zerolistmaker(len(self.x))
-		if len(self.waveformpacketsize) == 0: 
-			self.waveformpacketsize = self.zerolistmaker(len(self.x))
-		if len(self.returnpointwaveformlocation) == 0: 
-			self.returnpointwaveformlocation = self.zerolistmaker(len(self.x))
-		if len(self.wavex) == 0: 
-			self.wavex = self.zerolistmaker(len(self.x))
-		if len(self.wavey) == 0: 
-			self.wavey = self.zerolistmaker(len(self.x))
-		if len(self.wavez) == 0: 
-			self.wavez = self.zerolistmaker(len(self.x))
-		if len(self.nir) == 0: 
-			self.nir = self.zerolistmaker(len(self.x))
-
-		if len(self.classificationflags) == 0:
-			self.classificationflags = self.zerolistmaker(len(self.x))
-		if len(self.scannerchannel) == 0:
-			self.scannerchannel = self.zerolistmaker(len(self.x))
-		if len(self.userdata) == 0:
-			self.userdata = self.zerolistmaker(len(self.x))
-		if len(self.scanangle) == 0:
-			self.scanangle = self.zerolistmaker(len(self.x))
-
-	def writepoints(self):
-		'''
-		write points in the ASPRS version 1.4 format
+	def writepoints(self, chunksize=65536):
+		'''
+		write points in the ASPRS version 1.4 format.
+		the point struct is compiled once, then each chunk of points is packed into a reusable buffer with pack_into and written to disc in a single call
 		'''
-		xs = self.hdr.Xscalefactor
-		ys = self.hdr.Yscalefactor
-		zs = self.hdr.Zscalefactor
-
-		xo = self.hdr.Xoffset
-		yo = self.hdr.Yoffset
-		zo = self.hdr.Zoffset
-	
 		self.fixemptylists()
+		if self.sortorder is not None:
+			self.reorder(self.spatialorder(self.sortorder))
+
+		# computebbox_offsets() has usually gathered the statistics already
+		if self.stats.pointcount != len(self.x):
+			self.stats = lasstats()
+			self.stats.update(self)
+		self.stats.applybbox(self.hdr)
+		self.stats.applycounts(self.hdr)
+		if self.hdr.compressed:
+			self.startcompression()
+		self.hdr.Offsettopointdata = self.hdr.HeaderSize + self.getVLRTotalLength()
+
+		# the points go directly after the VLRs
+		self.fileptr.seek(self.hdr.Offsettopointdata, 0)
+		self.encodepoints(self, chunksize)
+		if self.hdr.compressed:
+			self.finishcompression()
+		self.pointswritten = True
+
+	def setscaleoffset(self, xscale, yscale, zscale, xoffset, yoffset, zoffset):
+		'''
+		set the scale factors and offsets used to encode the coordinates.  when streaming with writebatch() these must cover every point you will write
+		'''
+		self.hdr.Xscalefactor = xscale
+		self.hdr.Yscalefactor = yscale
+		self.hdr.Zscalefactor = zscale
+		self.hdr.Xoffset = xoffset
+		self.hdr.Yoffset = yoffset
+		self.hdr.Zoffset = zoffset
+		self.scaleoffsetset = True
+
+	def estimatescaleoffset(self, points):
+		'''
+		estimate a scale and offset from the first batch of points when streaming and the caller has not supplied them.
+		geographic coordinates get a scale of 0.0000001, anything else 0.001.  we only treat the coordinates as geographic when the caller or the coordinate system VLR says so, as a first batch of local coordinates can look like longitude and latitude.
+		the offsets are rounded down from the minimum so the other batches have plenty of room either side
+		'''
+		minx = min(points.x)
+		miny = min(points.y)
+		minz = min(points.z)
+		if self.geographic:
+			self.setscaleoffset(0.0000001, 0.0000001, 0.001, math.floor(minx), math.floor(miny), math.floor(minz))
+		else:
+			self.setscaleoffset(0.001, 0.001, 0.001, math.floor(minx / 1000) * 1000, math.floor(miny / 1000) * 1000, math.floor(minz))
 
-		self.hdr.LegacyNumberofpointrecords += len(self.x)
-		self.hdr.LegacyNumberofpointsbyreturn1 += len(self.x)
-		self.hdr.Numberofpointrecords += len(self.x)
-		self.hdr.Numberofpointsbyreturn1 += len(self.x)
-		if self.hdr.lasformat == 1.2:
-			self.hdr.Offsettopointdata = self.hdr.hdr12len + self.getVLRTotalLength()
-		if self.hdr.lasformat == 1.4:
-			self.hdr.Offsettopointdata = self.hdr.hdr14len + self.getVLRTotalLength()
-
-		if self.hdr.PointDataRecordFormat == 0:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
+	def writebatch(self, points=None, chunksize=65536):
+		'''
+		encode a batch of points and append it to the file straight away, so we never hold all the points in memory.
+		points is a laspoints object, such as a chunk from lasreader.iter_chunks().  if it is None the writer's own arrays are written and then cleared, so you can fill, write, fill, write...
+		the coordinates are encoded with the scale and offset from setscaleoffset(), or estimated from the first batch.  the bounding box and point counts are accumulated as we go, and the header is written when you call close()
+		'''
+		if points is None:
+			points = self
+		if len(points) == 0:
 			return
-		if self.hdr.PointDataRecordFormat == 1:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i],
-					self.gpstime[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
+		self.resume()
+		if self.sortorder is not None:
+			# we can only order the points within each batch.  use sortlasfile() to order the whole file
+			points.reorder(points.spatialorder(self.sortorder))
+		if not self.streaming:
+			if not self.scaleoffsetset:
+				self.estimatescaleoffset(points)
+			self.startstream()
+
+		points.fixemptylists()
+
+		# append after the points we have already written.  the whole batch is encoded before any of it is written, and the statistics are only updated after that, so a batch which does not fit the format leaves the file and the header alone
+		self.fileptr.seek(self.hdr.Offsettopointdata + (self.hdr.Numberofpointrecords * self.hdr.getpointstruct().size), 0)
+		self.encodepoints(points, chunksize, True)
+		self.stats.update(points)
+		self.hdr.Numberofpointrecords += len(points.x)
+
+		if points is self:
+			self.clearpoints()
+
+	def writepointbytes(self, data):
+		'''
+		append a block of raw point records, as returned by lasreader.readpointbytes(), to the file without decoding and encoding them.
+		the records must already be in this writer's point format, scale and offset, eg after copyheader().  only x, y, z and the return number are decoded, for the header statistics
+		'''
+		if len(data) == 0:
 			return
+		self.resume()
+		if not self.streaming:
+			if not self.scaleoffsetset:
+				raise ValueError("set the scale and offset of the raw records with setscaleoffset() or copyheader() before writing them")
+			self.startstream()
+
+		columns = decodepointfields(data, self.hdr, ["x", "y", "z", "returnnumber"])
+		batch = laspoints()
+		for name, column in columns.items():
+			setattr(batch, name, column)
+		self.stats.update(batch)
+
+		self.fileptr.seek(self.hdr.Offsettopointdata + (self.hdr.Numberofpointrecords * self.hdr.getpointstruct().size), 0)
+		if self.hdr.compressed:
+			self.compresspointbytes(data)
+		else:
+			self.fileptr.write(data)
+		self.hdr.Numberofpointrecords += len(batch.x)
 
-		if self.hdr.PointDataRecordFormat == 2:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def startstream(self):
+		'''
+		start streaming points to the file.  the points go after the VLRs, so no more VLRs can be written after this
+		'''
+		if self.hdr.compressed:
+			self.startcompression()
+		self.hdr.Offsettopointdata = self.hdr.HeaderSize + self.getVLRTotalLength()
+		self.stats = lasstats()
+		self.streaming = True
 
-		if self.hdr.PointDataRecordFormat == 3:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def copyheader(self, reader, exclude=()):
+		'''
+		set up this writer to take the raw point records of another file: the point format, record length, scale, offset and global encoding are copied from the reader's header, with its VLRs and extended VLRs.
+		the LASzip VLR is not copied, as it describes the compression of the source file, nor are any VLRs whose (userid, recordid) is in exclude
+		'''
+		self.hdr.PointDataRecordFormat = reader.hdr.PointDataRecordFormat
+		self.hdr.PointDataRecordLength = reader.hdr.PointDataRecordLength
+		self.hdr.FileSourceID = reader.hdr.FileSourceID
+		self.hdr.GlobalEncoding = reader.hdr.GlobalEncoding
+		self.setscaleoffset(reader.hdr.Xscalefactor, reader.hdr.Yscalefactor, reader.hdr.Zscalefactor, reader.hdr.Xoffset, reader.hdr.Yoffset, reader.hdr.Zoffset)
+		for vlr in reader.vlrs:
+			if vlr.userid == b'laszip encoded' or (vlr.userid, vlr.recordid) in exclude:
+				continue
+			self.writeVLR(vlr.userid, vlr.recordid, vlr.description, bytes(reader.getvlrdata(vlr)))
+		if self.hdr.lasformat == 1.4:
+			for vlr in reader.evlrs:
+				if (vlr.userid, vlr.recordid) in exclude:
+					continue
+				self.writeEVLR(vlr.userid, vlr.recordid, vlr.description, bytes(reader.getvlrdata(vlr)))
 
-		if self.hdr.PointDataRecordFormat == 4:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.wavepacketdescriptorindex[i],
-					self.byteoffsettowaveformdata[i],
-					self.waveformpacketsize[i],
-					self.returnpointwaveformlocation[i],
-					self.wavex[i],
-					self.wavey[i],
-					self.wavez[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def finalisestream(self):
+		'''
+		patch the header with the point counts accumulated while streaming
+		'''
+		if self.hdr.compressed:
+			self.finishcompression()
+		self.stats.applybbox(self.hdr)
+		self.stats.applycounts(self.hdr)
+		self.writeHeader()
 
-		if self.hdr.PointDataRecordFormat == 5:
-			for i in range(len(self.x)):
-				flags = self.setpointflags(self.returnnumber[i], self.numberreturns[i], self.scandirectionflag[i], self.edgeflightline[i])
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flags,
-					self.classification[i],
-					self.scanangle[i],
-					self.userdata[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i],
-					self.wavepacketdescriptorindex[i],
-					self.byteoffsettowaveformdata[i],
-					self.waveformpacketsize[i],
-					self.returnpointwaveformlocation[i],
-					self.wavex[i],
-					self.wavey[i],
-					self.wavez[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def encodepoints(self, points, chunksize=65536, wholebatch=False):
+		'''
+		encode the points and write them at the current file position.  each chunk is packed into a reusable buffer and written with one call.
+		if wholebatch is True every chunk is packed before any is written, so a point which does not fit the point format leaves the file and the LAZ chunks untouched
+		'''
+		record_struct = self.hdr.getpointstruct()
+		pack_into = record_struct.pack_into
+		recordlength = record_struct.size
+		count = len(points.x)
+		buffersize = recordlength * (count if wholebatch else min(chunksize, count))
+		if len(self.encodebuffer) < buffersize:
+			self.encodebuffer = bytearray(buffersize)
+		buf = self.encodebuffer
+		view = memoryview(buf)
+
+		offset = 0
+		for start in range(0, count, chunksize):
+			end = min(start + chunksize, count)
+			if not wholebatch:
+				offset = 0
+			try:
+				for n in zip(*self.encodecolumns(points, start, end)):
+					pack_into(buf, offset, *n)
+					offset += recordlength
+			except struct.error as e:
+				view.release()
+				point = (offset // recordlength) if wholebatch else start + (offset // recordlength)
+				raise ValueError("point %d does not fit the point format, check the scale and offset cover the data: %s" % (point, e))
+			if not wholebatch:
+				self.writeencoded(view[:offset])
+		if wholebatch:
+			self.writeencoded(view[:offset])
+		view.release()
+
+	def writeencoded(self, data):
+		'''
+		write encoded point records at the current file position, or queue them for compression
+		'''
+		if self.hdr.compressed:
+			self.compresspointbytes(data)
+		else:
+			self.fileptr.write(data)
 
-		if self.hdr.PointDataRecordFormat == 6:
-			for i in range(len(self.x)):
-				flag1 = self.setpointflag1_6_10(self.returnnumber[i], self.numberreturns[i])
-				flag2 = self.setpointflag2_6_10(self.classificationflags[i], self.scannerchannel[i], self.scandirectionflag[i], self.edgeflightline[i] )
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flag1,
-					flag2,
-					self.classification[i],
-					self.userdata[i],
-					self.scanangle[i],
-					self.pointsourceid[i],
-					self.gpstime[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
+	def startcompression(self):
+		'''
+		add the LASzip VLR that describes the compression, and reserve the 8 bytes at the start of the points block for the offset to the chunk table
+		'''
+		extrabytes = self.hdr.PointDataRecordLength - self.supportedformats[self.hdr.PointDataRecordFormat][1]
+		vlr = lazrs.LazVlr.new_for_compression(self.hdr.PointDataRecordFormat, extrabytes, self.variablechunks)
+		self.lazvlrdata = vlr.record_data()
+		self.writeVLR(b'laszip encoded', 22204, b'http://laszip.org', self.lazvlrdata)
+		# with variable size chunks we still aim for the usual 50000 points in each
+		self.lazchunksize = 50000 if self.variablechunks else vlr.chunk_size()
+		self.lazpending = bytearray()
+		self.lazchunks = []
+		self.lazoffset = self.hdr.HeaderSize + self.getVLRTotalLength() + 8
+		if self.workers > 1 and self.pool is None:
+			self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+	def compresspointbytes(self, data):
+		'''
+		queue encoded point records for compression.  each full chunk is compressed in the process pool, and the chunks are written to disc in order as they finish
+		'''
+		self.lazpending += data
+		chunkbytes = self.lazchunksize * self.hdr.getpointstruct().size
+		start = 0
+		while len(self.lazpending) - start >= chunkbytes:
+			self.submitlazchunk(bytes(self.lazpending[start:start + chunkbytes]))
+			start += chunkbytes
+		del self.lazpending[:start]
+
+	def submitlazchunk(self, data):
+		'''
+		compress a chunk of point records.  we keep at most two chunks per worker in flight, so memory use stays bounded
+		'''
+		pointcount = len(data) // self.hdr.getpointstruct().size
+		if self.pool is None:
+			self.writelazchunk(pointcount, compresslazchunk(self.lazvlrdata, data))
 			return
+		self.lazfutures.append((pointcount, self.pool.submit(compresslazchunk, self.lazvlrdata, data)))
+		while len(self.lazfutures) > 2 * self.workers:
+			pointcount, future = self.lazfutures.popleft()
+			self.writelazchunk(pointcount, future.result())
 
-		if self.hdr.PointDataRecordFormat == 7:
-			for i in range(len(self.x)):
-				flag1 = self.setpointflag1_6_10(self.returnnumber[i], self.numberreturns[i])
-				flag2 = self.setpointflag2_6_10(self.classificationflags[i], self.scannerchannel[i], self.scandirectionflag[i], self.edgeflightline[i] )
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flag1,
-					flag2,
-					self.classification[i],
-					self.userdata[i],
-					self.scanangle[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def writelazchunk(self, pointcount, chunk):
+		'''
+		write a compressed chunk after the chunks already written, and add it to the chunk table
+		'''
+		self.fileptr.seek(self.lazoffset, 0)
+		self.fileptr.write(chunk)
+		self.lazoffset += len(chunk)
+		self.lazchunks.append((pointcount, len(chunk)))
 
-		if self.hdr.PointDataRecordFormat == 8:
-			for i in range(len(self.x)):
-				flag1 = self.setpointflag1_6_10(self.returnnumber[i], self.numberreturns[i])
-				flag2 = self.setpointflag2_6_10(self.classificationflags[i], self.scannerchannel[i], self.scandirectionflag[i], self.edgeflightline[i] )
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flag1,
-					flag2,
-					self.classification[i],
-					self.userdata[i],
-					self.scanangle[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i],
-					self.nir[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+	def finishcompression(self):
+		'''
+		compress the last, part filled, chunk and wait for the pool, then write the chunk table and its offset at the start of the points block
+		'''
+		if len(self.lazpending) > 0:
+			self.submitlazchunk(bytes(self.lazpending))
+			self.lazpending = bytearray()
+		while len(self.lazfutures) > 0:
+			pointcount, future = self.lazfutures.popleft()
+			self.writelazchunk(pointcount, future.result())
+		self.fileptr.seek(self.hdr.Offsettopointdata, 0)
+		self.fileptr.write(struct.pack("<q", self.lazoffset))
+		self.fileptr.seek(self.lazoffset, 0)
+		lazrs.write_chunk_table(self.fileptr, self.lazchunks, lazrs.LazVlr(self.lazvlrdata))
+		self.lazend = self.fileptr.tell()
+		self.fileptr.flush()
+
+	def encodecolumns(self, points, start, end):
+		'''
+		return the columns of values for points start to end, in the order of the fields of the current point format, ready for packing.
+		coordinates are converted to scaled integers and the bit fields are packed into their flag bytes
+		'''
+		xs = self.hdr.Xscalefactor
+		ys = self.hdr.Yscalefactor
+		zs = self.hdr.Zscalefactor
 
-		if self.hdr.PointDataRecordFormat == 9:
-			for i in range(len(self.x)):
-				flag1 = self.setpointflag1_6_10(self.returnnumber[i], self.numberreturns[i])
-				flag2 = self.setpointflag2_6_10(self.classificationflags[i], self.scannerchannel[i], self.scandirectionflag[i], self.edgeflightline[i] )
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flag1,
-					flag2,
-					self.classification[i],
-					self.userdata[i],
-					self.scanangle[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.wavepacketdescriptorindex[i],
-					self.byteoffsettowaveformdata[i],
-					self.waveformpacketsize[i],
-					self.returnpointwaveformlocation[i],
-					self.wavex[i],
-					self.wavey[i],
-					self.wavez[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+		xo = self.hdr.Xoffset
+		yo = self.hdr.Yoffset
+		zo = self.hdr.Zoffset
 
-		if self.hdr.PointDataRecordFormat == 10:
-			for i in range(len(self.x)):
-				flag1 = self.setpointflag1_6_10(self.returnnumber[i], self.numberreturns[i])
-				flag2 = self.setpointflag2_6_10(self.classificationflags[i], self.scannerchannel[i], self.scandirectionflag[i], self.edgeflightline[i] )
-				n = (int((self.x[i] - xo) / xs),
-					int((self.y [i] - yo) / ys),
-					int((self.z [i] - zo) / zs),
-					int(self.intensity[i]),
-					flag1,
-					flag2,
-					self.classification[i],
-					self.userdata[i],
-					self.scanangle[i],
-					self.pointsourceid[i],
-					self.gpstime[i],
-					self.red[i],
-					self.green[i],
-					self.blue[i],
-					self.nir[i],
-					self.wavepacketdescriptorindex[i],
-					self.byteoffsettowaveformdata[i],
-					self.waveformpacketsize[i],
-					self.returnpointwaveformlocation[i],
-					self.wavex[i],
-					self.wavey[i],
-					self.wavez[i]
-					)
-				# now write the record to disc
-				record_struct = struct.Struct(self.supportedformats[self.hdr.PointDataRecordFormat][0])
-				self.fileptr.write(record_struct.pack(*n))
-			return
+		columns = []
+		for name in self.hdr.getpointformatfields()[self.hdr.PointDataRecordFormat]:
+			if name == "x":
+				columns.append([round((v - xo) / xs) for v in points.x[start:end]])
+			elif name == "y":
+				columns.append([round((v - yo) / ys) for v in points.y[start:end]])
+			elif name == "z":
+				columns.append([round((v - zo) / zs) for v in points.z[start:end]])
+			elif name == "intensity":
+				columns.append([int(v) for v in points.intensity[start:end]])
+			elif name == "flags":
+				columns.append(packflags(points, legacyflagfields, start, end))
+			elif name == "flag1":
+				columns.append(packflags(points, extendedflag1fields, start, end))
+			elif name == "flag2":
+				columns.append(packflags(points, extendedflag2fields, start, end))
+			elif name == "classification" and self.hdr.PointDataRecordFormat <= 5:
+				columns.append(packflags(points, legacyclassificationfields, start, end))
+			else:
+				columns.append(getattr(points, name)[start:end])
+		return columns
 
 	def close(self):
+		'''
+		close the file.  if we have been streaming points with writebatch(), the header is patched with the final bounding box and counts first.
+		if the header has not been written at all, it is written now.  after writepoints() it holds that call's statistics, otherwise nothing has been written, eg from an empty input, so an empty stream is started and finalised to give a valid header and VLRs
+		'''
+		if self.suspended:
+			self.resume()
+		if not self.streaming and not self.headerwritten:
+			if self.pointswritten:
+				self.writeHeader()
+			else:
+				self.startstream()
+		if self.streaming:
+			self.finalisestream()
+			self.streaming = False
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
 		self.fileptr.close()
+
+	def suspend(self):
+		'''
+		close the file handle while streaming, so many writers can be kept without running out of file handles.  the next write, or close(), reopens it with resume().
+		any LAZ chunks being compressed are written first.  with variable size chunks the part filled chunk is compressed too, so nothing is left in memory
+		'''
+		if self.suspended:
+			return
+		if self.hdr.compressed and self.lazvlrdata is not None:
+			if self.variablechunks and len(self.lazpending) > 0:
+				self.submitlazchunk(bytes(self.lazpending))
+				self.lazpending = bytearray()
+			while len(self.lazfutures) > 0:
+				pointcount, future = self.lazfutures.popleft()
+				self.writelazchunk(pointcount, future.result())
+		self.fileptr.close()
+		self.suspended = True
+
+	def resume(self):
+		'''
+		reopen the file after suspend()
+		'''
+		if self.suspended:
+			self.fileptr = open(self.fileName, 'rb+')
+			self.suspended = False
 		
 	def rewind(self):
 		# go back to start of file
@@ -566,10 +1113,41 @@ class laswriter:
 		# set the file pointer to the start of the points block
 		self.fileptr.seek(self.hdr.Offsettopointdata + (self.hdr.Numberofpointrecords * self.hdr.PointDataRecordLength), 0)
 
+	def writeEVLR(self, userid, recordid, description, vlrdata):
+		'''
+		queue an extended variable length record.  EVLRs go after the point records, so they are written when the header is written
+		'''
+		if self.hdr.lasformat != 1.4:
+			raise ValueError("extended VLRs need las version 1.4")
+		self.evlrs.append(lasvlr(userid, recordid, description, len(vlrdata), 0, vlrdata, True))
+
+	def writeEVLRs(self):
+		'''
+		write the queued extended VLRs directly after the point records, and record where they start in the header
+		'''
+		if self.hdr.compressed:
+			position = self.lazend
+		else:
+			position = self.hdr.Offsettopointdata + (self.hdr.Numberofpointrecords * self.hdr.PointDataRecordLength)
+		self.fileptr.seek(position, 0)
+		record_struct = struct.Struct(self.hdr.evlrhdr14fmt)
+		for vlr in self.evlrs:
+			# the waveform packets are an EVLR, and the header records where it starts
+			if vlr.userid == b'LASF_Spec' and vlr.recordid == 65535:
+				self.hdr.StartofWaveformDataPacketRecord = self.fileptr.tell()
+			self.fileptr.write(record_struct.pack(0, vlr.userid, vlr.recordid, len(vlr.data), vlr.description))
+			self.fileptr.write(vlr.data)
+		self.fileptr.truncate()
+		self.hdr.StartoffirstExtendedVariableLengthRecord = position
+		self.hdr.NumberofExtendedVariableLengthRecords = len(self.evlrs)
+
 	def writeHeader(self):
 		'''
-		convert the header variables into a list, then conver the list into a tuple so we can pack it
+		convert the header variables into a list, then conver the list into a tuple so we can pack it.
+		any extended VLRs are written first, so the header knows where they are
 		'''
+		if len(self.evlrs) > 0:
+			self.writeEVLRs()
 		values = self.hdr.hdr2tuple()
 		if self.hdr.lasformat == 1.2:
 			s = struct.Struct(self.hdr.hdr12fmt)
@@ -578,6 +1156,7 @@ class laswriter:
 		data = s.pack(*values)
 		self.fileptr.seek(0, 0)				
 		self.fileptr.write(data)
+		self.headerwritten = True
 
 	def setpointflags(self, returnnumber, numberreturns, scandirectionflag, edgeflightline ):
 		flags = 0
@@ -618,295 +1197,115 @@ class laswriter:
 		'''
 		set the bit if this is the edge of a scan
 		'''
-		if edgeflightline: 
-			int_type = self.bitSet(int_type, 7)
-		return int_type
+		return int_type | bitfieldencodetables[(7, 1)][edgeflightline & 0xff]
 
 	def setBitsFor_scandirectionflag(self, int_type, scandirectionflag):
-		if scandirectionflag: #positive direction
-			int_type = self.bitSet(int_type, 6)
-		return int_type
+		'''
+		set the bit if the scan direction is positive
+		'''
+		return int_type | bitfieldencodetables[(6, 1)][scandirectionflag & 0xff]
 
 	def setBitsFor_numberreturns(self, int_type, numberreturns):
 		'''
 		packs the number of returns into the byte at the correct offset
+		bits 3-5
 		'''
-		if numberreturns == 0:
-			return int_type
-		if numberreturns == 1:
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if numberreturns == 2:
-			int_type = self.bitSet(int_type, 4)
-			return int_type
-		if numberreturns == 3:
-			int_type = self.bitSet(int_type, 3)
-			int_type = self.bitSet(int_type, 4)
-			return int_type
-		if numberreturns == 4:
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		if numberreturns == 5:
-			int_type = self.bitSet(int_type, 3)
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(3, 3)][numberreturns & 0xff]
 
 	def setBitsFor_returnNo(self, int_type, returnNo):
 		'''
 		packs the return number into the byte at the correct offset
+		bits 0-2
 		'''
-		if returnNo == 0:
-			return int_type
-		if returnNo == 1:
-			int_type = self.bitSet(int_type, 0)
-			return int_type
-		if returnNo == 2:
-			int_type = self.bitSet(int_type, 1)
-			return int_type
-		if returnNo == 3:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			return int_type
-		if returnNo == 4:
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if returnNo == 5:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(0, 3)][returnNo & 0xff]
 
 	def setBitsFor_returnNo6_10(self, int_type, returnNo):
 		'''
 		packs the return number into the byte at the correct offset for the las v1.4
 		bits 0-3
 		'''
-
-		if returnNo == 0:
-			return int_type
-		if returnNo == 1:
-			int_type = self.bitSet(int_type, 0)
-			return int_type
-		if returnNo == 2:
-			int_type = self.bitSet(int_type, 1)
-		if returnNo == 3:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			return int_type
-		if returnNo == 4:
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if returnNo == 5:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if returnNo == 6:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if returnNo == 7:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if returnNo == 8:
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 9:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 10:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 11:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 12:
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 13:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 14:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if returnNo == 15:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(0, 4)][returnNo & 0xff]
 
 	def setBitsFor_numberreturns6_10(self, int_type, numberreturns):
 		'''
 		packs the number of return into the byte at the correct offset for the las v1.4
 		# bits 4-7
 		'''
-		if numberreturns == 0:
-			return int_type
-		if numberreturns == 1:
-			int_type = self.bitSet(int_type, 4)
-			return int_type
-		if numberreturns == 2:
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		if numberreturns == 3:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		if numberreturns == 4:
-			int_type = self.bitSet(int_type, 6)
-			return int_type
-		if numberreturns == 5:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 6)
-			return int_type
-		if numberreturns == 6:
-			int_type = self.bitSet(int_type, 5)
-			int_type = self.bitSet(int_type, 6)
-			return int_type
-		if numberreturns == 7:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 5)
-			int_type = self.bitSet(int_type, 6)
-			return int_type
-		if numberreturns == 8:
-			int_type = self.bitSet(int_type, 8)
-			return int_type
-		if numberreturns == 9:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 8)
-			return int_type
-		if numberreturns == 10:
-			int_type = self.bitSet(int_type, 5)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		if numberreturns == 11:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 6)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		if numberreturns == 12:
-			int_type = self.bitSet(int_type, 6)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		if numberreturns == 13:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 6)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		if numberreturns == 14:
-			int_type = self.bitSet(int_type, 5)
-			int_type = self.bitSet(int_type, 6)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		if numberreturns == 15:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 5)
-			int_type = self.bitSet(int_type, 6)
-			int_type = self.bitSet(int_type, 7)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(4, 4)][numberreturns & 0xff]
 
 	def setBitsFor_classificationflags6_10(self, int_type, classificationflags):
 		'''
 		packs the classification flag at the correct offset for the las v1.4
 		# bits 0-3
 		'''
-		if classificationflags == 0:
-			return int_type
-		if classificationflags == 1:
-			int_type = self.bitSet(int_type, 0)
-			return int_type
-		if classificationflags == 2:
-			int_type = self.bitSet(int_type, 1)
-		if classificationflags == 3:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			return int_type
-		if classificationflags == 4:
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if classificationflags == 5:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if classificationflags == 6:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if classificationflags == 7:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			return int_type
-		if classificationflags == 8:
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 9:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 10:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 11:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 12:
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 13:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 14:
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		if classificationflags == 15:
-			int_type = self.bitSet(int_type, 0)
-			int_type = self.bitSet(int_type, 1)
-			int_type = self.bitSet(int_type, 2)
-			int_type = self.bitSet(int_type, 3)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(0, 4)][classificationflags & 0xff]
 
 	def setBitsFor_scannerchannel6_10(self, int_type, scannerchannel):
 		'''
 		packs the scanner channel at the correct offset for the las v1.4
 		# bits 4 & 5
 		'''
-		if scannerchannel == 0:
-			return int_type
-		if scannerchannel == 1:
-			int_type = self.bitSet(int_type, 4)
-			return int_type
-		if scannerchannel == 2:
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		if scannerchannel == 3:
-			int_type = self.bitSet(int_type, 4)
-			int_type = self.bitSet(int_type, 5)
-			return int_type
-		return int_type
+		return int_type | bitfieldencodetables[(4, 2)][scannerchannel & 0xff]
+
+###############################################################################
+class lasvlr:
+	'''
+	the header of a variable length record, or extended variable length record, and where its payload is in the file.
+	the payload is only read when it is asked for, see lasreader.getvlrdata().  when writing, data holds the payload
+	'''
+	def __init__(self, userid, recordid, description, length, offset, data=None, extended=False):
+		self.userid = userid
+		self.recordid = recordid
+		self.description = description
+		self.length = length
+		# byte offset of the payload from the start of the file
+		self.offset = offset
+		self.data = data
+		self.extended = extended
+
+	def __repr__(self):
+		return "lasvlr(%s, %d, %s, length=%d, offset=%d)" % (self.userid, self.recordid, self.description, self.length, self.offset)
+
+###############################################################################
+class laswavedescriptor:
+	'''
+	a waveform packet descriptor, from the payload of a VLR with record id 100 to 354.  it says how to decode the waveform samples of the points which use it
+	'''
+	def __init__(self, data=None):
+		self.fmt = "<BBLLdd"
+		self.bitspersample = 8
+		self.compressiontype = 0
+		self.numberofsamples = 0
+		# picoseconds between samples
+		self.temporalsamplespacing = 0
+		self.digitizergain = 1.0
+		self.digitizeroffset = 0.0
+		if data is not None:
+			s = struct.unpack(self.fmt, data[:struct.calcsize(self.fmt)])
+			self.bitspersample = s[0]
+			self.compressiontype = s[1]
+			self.numberofsamples = s[2]
+			self.temporalsamplespacing = s[3]
+			self.digitizergain = s[4]
+			self.digitizeroffset = s[5]
+
+	def decodesamples(self, data):
+		'''
+		return the raw samples of a waveform packet as an array.  volts are digitizergain * sample + digitizeroffset
+		'''
+		if self.compressiontype != 0:
+			raise ValueError("compressed waveform packets are not supported")
+		typecodes = {8: 'B', 16: 'H', 32: 'I'}
+		if self.bitspersample not in typecodes:
+			raise ValueError("waveform packets with %d bits per sample are not supported" % (self.bitspersample))
+		samples = array.array(typecodes[self.bitspersample])
+		samples.frombytes(data[:self.numberofsamples * samples.itemsize])
+		if sys.byteorder == "big":
+			samples.byteswap()
+		return samples
+
+	def __repr__(self):
+		return "laswavedescriptor(bits=%d, samples=%d, spacing=%dps, gain=%g, offset=%g)" % (self.bitspersample, self.numberofsamples, self.temporalsamplespacing, self.digitizergain, self.digitizeroffset)
 
 ###############################################################################
 class lashdr:
@@ -923,6 +1322,10 @@ class lashdr:
 		self.vlrhdr14fmt = "<H16sHH32s"
 		self.vlrhdr14len = struct.calcsize(self.vlrhdr14fmt)
 
+		# extended variable length record, v1.4 only.  the same as a VLR but with a 64 bit length
+		self.evlrhdr14fmt = "<H16sHQ32s"
+		self.evlrhdr14len = struct.calcsize(self.evlrhdr14fmt)
+
 		self.lasformat = lasformat # default to version 1.4.
 
 		# create a default template for a V1.4 header.  We use this for writing purposes
@@ -943,10 +1346,15 @@ class lashdr:
 		self.GeneratingSoftware =				  b'pylasfile'
 		self.FileCreationDayofYear =			   datetime.datetime.now().timetuple().tm_yday
 		self.FileCreationYear =					datetime.datetime.now().year
-		self.HeaderSize =						  375
+		if self.lasformat == 1.2:
+			self.HeaderSize =					  self.hdr12len
+		else:
+			self.HeaderSize =					  self.hdr14len
 		self.Offsettopointdata =				   0
 		self.NumberofVariableLengthRecords =	   0
 		self.PointDataRecordFormat =			   1
+		# true if the point records are compressed with LASzip.  the point format in the file then has bit 7 set
+		self.compressed =						  False
 		self.PointDataRecordLength =			   28
 
 		self.LegacyNumberofpointrecords =		  0
@@ -1007,27 +1415,27 @@ class lashdr:
 		s.append([fmt,fmtlen])
 
 		# format 1, v1.2,v1.4
-		fmt = "<lllH BB B BH d"
+		fmt = "<lllH BB b BH d"
 		fmtlen = struct.calcsize(fmt)
 		s.append([fmt,fmtlen])
 
 		# format 2, v1.2,v1.4
-		fmt = "<lllH B BBBH HHH"
+		fmt = "<lllH B BbBH HHH"
 		fmtlen = struct.calcsize(fmt)
 		s.append([fmt,fmtlen])
 
 		# format 3, v1.2,v1.4
-		fmt = "<lllH B BBBH d HHH"
+		fmt = "<lllH B BbBH d HHH"
 		fmtlen = struct.calcsize(fmt)
 		s.append([fmt,fmtlen])
 
 		# format 4, v1.4
-		fmt = "<lllH BBBBH d BQLffff"
+		fmt = "<lllH BBbBH d BQLffff"
 		fmtlen = struct.calcsize(fmt)
 		s.append([fmt,fmtlen])
 	
 		# format 5, v1.4
-		fmt = "<lllH BBBB HdHH H BQLffff"
+		fmt = "<lllH BBbB HdHH H BQLffff"
 		fmtlen = struct.calcsize(fmt)
 		s.append([fmt,fmtlen])
 
@@ -1058,6 +1466,78 @@ class lashdr:
 
 		return s
 
+	def getpointformatfields(self):
+		'''
+		returns the names of the fields in each of the supported point formats, in the same order as the values unpacked by the format struct.
+		the names match the laspoints attributes.  'flags' is the packed return byte of formats 0-5, 'flag1' and 'flag2' are the packed return and classification flag bytes of formats 6-10
+		'''
+		legacy = ["x", "y", "z", "intensity", "flags", "classification", "scanangle", "userdata", "pointsourceid"]
+		extended = ["x", "y", "z", "intensity", "flag1", "flag2", "classification", "userdata", "scanangle", "pointsourceid", "gpstime"]
+		rgb = ["red", "green", "blue"]
+		wave = ["wavepacketdescriptorindex", "byteoffsettowaveformdata", "waveformpacketsize", "returnpointwaveformlocation", "wavex", "wavey", "wavez"]
+
+		s = []
+		s.append(legacy)										# format 0
+		s.append(legacy + ["gpstime"])							# format 1
+		s.append(legacy + rgb)									# format 2
+		s.append(legacy + ["gpstime"] + rgb)					# format 3
+		s.append(legacy + ["gpstime"] + wave)					# format 4
+		s.append(legacy + ["gpstime"] + rgb + wave)				# format 5
+		s.append(extended)										# format 6
+		s.append(extended + rgb)								# format 7
+		s.append(extended + rgb + ["nir"])						# format 8
+		s.append(extended + wave)								# format 9
+		s.append(extended + rgb + ["nir"] + wave)				# format 10
+		return s
+
+	def getpointbitfields(self):
+		'''
+		returns a dictionary of the attributes which are packed into bit fields in the current point format.  each entry gives the name of the byte the attribute lives in, its first bit and its number of bits
+		'''
+		bitfields = {}
+		if self.PointDataRecordFormat <= 5:
+			packed = [("flags", legacyflagfields), ("classification", legacyclassificationfields)]
+		else:
+			packed = [("flag1", extendedflag1fields), ("flag2", extendedflag2fields)]
+		for field, fields in packed:
+			for name, shift, width in fields:
+				bitfields[name] = (field, shift, width)
+		return bitfields
+
+	def getpointattributes(self):
+		'''
+		returns the names of all the laspoints attributes held in the current point format, with the flag bytes expanded into their bit fields
+		'''
+		bitfields = self.getpointbitfields()
+		flagbytes = set([field for field, shift, width in bitfields.values()])
+		names = [name for name in self.getpointformatfields()[self.PointDataRecordFormat] if name not in flagbytes]
+		return names + [name for name in bitfields if name not in names]
+
+	def getpointfieldlayout(self):
+		'''
+		returns a dictionary of the fields in the current point format.  each entry gives the byte offset of the field within the record and its struct format character
+		'''
+		fmt = self.getsuportedpointformats()[self.PointDataRecordFormat][0].replace(" ", "")
+		names = self.getpointformatfields()[self.PointDataRecordFormat]
+		layout = {}
+		for i in range(len(names)):
+			layout[names[i]] = (struct.calcsize(fmt[:i + 1]), fmt[i + 1])
+		return layout
+
+	def getpointstruct(self):
+		'''
+		return a compiled struct for the current point format.  the struct is padded out to the point data record length so any extra bytes on the end of each record are skipped.  structs are cached so the format string is only parsed once per format
+		'''
+		key = (self.PointDataRecordFormat, self.PointDataRecordLength)
+		s = pointstructcache.get(key)
+		if s is None:
+			fmt, fmtlen = self.getsuportedpointformats()[self.PointDataRecordFormat]
+			if self.PointDataRecordLength > fmtlen:
+				fmt = fmt + "%dx" % (self.PointDataRecordLength - fmtlen)
+			s = struct.Struct(fmt)
+			pointstructcache[key] = s
+		return s
+
 	def hdr2tuple(self):
 		'''
 		convert the header properties into a tuple so we can easily write it to disc using struct
@@ -1080,7 +1560,7 @@ class lashdr:
 				self.HeaderSize,
 				self.Offsettopointdata,
 				self.NumberofVariableLengthRecords,
-				self.PointDataRecordFormat,
+				self.PointDataRecordFormat | (0x80 if self.compressed else 0),
 				self.PointDataRecordLength,
 				self.LegacyNumberofpointrecords,
 				self.LegacyNumberofpointsbyreturn1,
@@ -1119,7 +1599,7 @@ class lashdr:
 				self.HeaderSize,
 				self.Offsettopointdata,
 				self.NumberofVariableLengthRecords,
-				self.PointDataRecordFormat,
+				self.PointDataRecordFormat | (0x80 if self.compressed else 0),
 				self.PointDataRecordLength,
 				self.LegacyNumberofpointrecords,
 				self.LegacyNumberofpointsbyreturn1,
@@ -1188,7 +1668,8 @@ class lashdr:
 			self.HeaderSize =						  s[13]
 			self.Offsettopointdata =				   s[14]
 			self.NumberofVariableLengthRecords =	   s[15]
-			self.PointDataRecordFormat =			   s[16]
+			self.PointDataRecordFormat =			   s[16] & 0x3f
+			self.compressed =						  (s[16] & 0x80) != 0
 			self.PointDataRecordLength =			   s[17]
 
 			self.LegacyNumberofpointrecords =		  s[18]
@@ -1211,6 +1692,14 @@ class lashdr:
 			self.MaxZ =								s[34]
 			self.MinZ =								s[35]
 
+			# v1.2 only has the legacy counts, so copy them into the v1.4 fields we use everywhere else
+			self.Numberofpointrecords =				self.LegacyNumberofpointrecords
+			self.Numberofpointsbyreturn1 =			 self.LegacyNumberofpointsbyreturn1
+			self.Numberofpointsbyreturn2 =			 self.LegacyNumberofpointsbyreturn2
+			self.Numberofpointsbyreturn3 =			 self.LegacyNumberofpointsbyreturn3
+			self.Numberofpointsbyreturn4 =			 self.LegacyNumberofpointsbyreturn4
+			self.Numberofpointsbyreturn5 =			 self.LegacyNumberofpointsbyreturn5
+
 		if self.lasformat == 1.4:
 		
 			s = struct.unpack(self.hdr14fmt, data)
@@ -1232,7 +1721,8 @@ class lashdr:
 			self.HeaderSize =						  s[13]
 			self.Offsettopointdata =				   s[14]
 			self.NumberofVariableLengthRecords =	   s[15]
-			self.PointDataRecordFormat =			   s[16]
+			self.PointDataRecordFormat =			   s[16] & 0x3f
+			self.compressed =						  (s[16] & 0x80) != 0
 			self.PointDataRecordLength =			   s[17]
 
 			self.LegacyNumberofpointrecords =		  s[18]
@@ -1287,54 +1777,94 @@ class lashdr:
 	PointDataRecordFormat = property(get_PointDataRecordFormat,set_PointDataRecordFormat)
 
 ###############################################################################
-class lasreader:
-	def __init__(self, filename):
+class lasreader(laspoints):
+	def __init__(self, filename, mmap=False, workers=None):
 		if not os.path.isfile(filename):
 			print ("file not found:", filename)
 		self.fileName = filename
 		self.fileptr = open(filename, 'rb')		
 		self.fileSize = os.path.getsize(filename)
+
+		# in mmap mode the file is mapped once and all reads are served as memoryview slices of the mapping
+		self.filemap = None
+		self.fileview = None
+
+		# the spatial index used by query_bbox, loaded from the sidecar file when first needed
+		self.index = None
+
+		# the VLRs and extended VLRs, found when the header is read.  their payloads are read on demand
+		self.vlrs = []
+		self.evlrs = []
+
+		# the memory map of the waveform packets, in this file or the .wdp file next to it.  see read_waveforms()
+		self.waveformmap = None
+		self.waveformview = None
+		self.waveformbase = 0
+
+		# state for LAZ files.  the point position is tracked here, as the file position does not map onto a point record
+		self.lazvlrdata = None
+		self.lazchunks = []
+		self.lazchunkstarts = []
+		self.lazcache = (-1, b"")
+		self.pointposition = 0
+		# the number of processes used to decompress LAZ chunks, default is one per cpu
+		self.workers = workers if workers is not None else os.cpu_count()
+		self.pool = None
+		if mmap:
+			self.mapfile()
+
 		self.hdr = lashdr()
 		self.supportedformats = self.hdr.getsuportedpointformats()
 
-		# the lists of all the data we will populate, then write into whatever format the user desires.  
-		# these could be numpy arrays, but that introduces a dependency, so we will leave them as lists
-		self.x = []
-		self.y = []
-		self.z = []
-		self.intensity = []
-		self.returnnumber = []
-		self.numberreturns = []
-		self.scandirectionflag = []
-		self.edgeflightline = []
-		self.classification = []
-		self.scananglerank = []
-		self.userdata = []
-		self.pointsourceid = []
-		self.gpstime = []
-		self.red = []
-		self.green = []
-		self.blue = []
-		self.wavepacketdescriptorindex = []
-		self.byteoffsettowaveformdata = []
-		self.waveformpacketsize = []
-		self.returnpointwaveformlocation = []
-		self.wavex = []
-		self.wavey = []
-		self.wavez = []
-		self.nir = []
-
-		self.classificationflags = []
-		self.scannerchannel = []
-		self.userdata = []
-		self.scanangle = []
+		# the arrays of all the data we will populate, then use in whatever way the user desires.
+		laspoints.__init__(self)
 
 	def close(self):
 		'''
 		close the file
 		'''
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
+		if self.waveformview is not None:
+			self.waveformview.release()
+			self.waveformview = None
+			self.waveformmap.close()
+			self.waveformmap = None
+		if self.fileview is not None:
+			self.fileview.release()
+			self.fileview = None
+		try:
+			self.fileptr.close()
+		except BufferError:
+			# the caller still holds memoryviews of the mapping. it will be unmapped when the last of them is released
+			pass
+
+	def mapfile(self):
+		'''
+		memory map the file read only.  the mapping replaces the file pointer, so seek and tell work as normal, but read() returns zero copy memoryview slices rather than bytes copied onto the heap.  several readers of the same file share the same physical pages
+		'''
+		if self.fileSize == 0:
+			# an empty file cannot be mapped, so stay with normal reads
+			return
+		filemap = mmap.mmap(self.fileptr.fileno(), 0, access=mmap.ACCESS_READ)
+		# the mapping holds its own handle on the file, so we can close ours
 		self.fileptr.close()
-		
+		self.fileptr = filemap
+		self.filemap = filemap
+		self.fileview = memoryview(filemap)
+
+	def read(self, bytesToRead):
+		'''
+		read bytes from the current file position.  in mmap mode this returns a memoryview of the mapping and nothing is copied
+		'''
+		if self.filemap is None:
+			return self.fileptr.read(bytesToRead)
+		start = self.filemap.tell()
+		data = self.fileview[start:start + bytesToRead]
+		self.filemap.seek(start + len(data))
+		return data
+
 	def rewind(self):
 		'''
 		go back to start of file
@@ -1345,14 +1875,43 @@ class lasreader:
 		'''
 		set the file pointer to the START of the points block so we can write some records
 		'''
+		if self.hdr.compressed:
+			self.pointposition = 0
+			return
 		self.fileptr.seek(self.hdr.Offsettopointdata, 0)				
 
 	def seekPointRecordEnd(self):
 		'''
 		set the file pointer to the END of the points block so we can add new records
 		'''
+		if self.hdr.compressed:
+			self.pointposition = self.hdr.Numberofpointrecords
+			if len(self.lazchunks) > 0:
+				firstpoint, pointcount, offset, bytecount = self.lazchunks[-1]
+				self.fileptr.seek(offset + bytecount, 0)
+			return
 		self.fileptr.seek(self.hdr.Offsettopointdata + (self.hdr.Numberofpointrecords*self.hdr.PointDataRecordLength), 0)
 
+	def seekPointRecord(self, index):
+		'''
+		set the file pointer to the start of point record number index.  records are a fixed length, so we can go straight there
+		'''
+		if self.hdr.compressed:
+			self.pointposition = index
+			return
+		self.fileptr.seek(self.hdr.Offsettopointdata + (index * self.hdr.getpointstruct().size), 0)
+
+	def tellPointRecord(self):
+		'''
+		return the index of the point record at the current file position.  if the file pointer is before the points block this is 0
+		'''
+		if self.hdr.compressed:
+			return self.pointposition
+		position = self.fileptr.tell() - self.hdr.Offsettopointdata
+		if position < 0:
+			return 0
+		return position // self.hdr.getpointstruct().size
+
 	def __str__(self):
 		'''
 		pretty print this class
@@ -1366,7 +1925,7 @@ class lasreader:
 		curr = self.fileptr.tell()
 
 		snifffmt = "<4sHHLHH8sBB"
-		data = self.fileptr.read(struct.calcsize(snifffmt))
+		data = self.read(struct.calcsize(snifffmt))
 		s = struct.unpack(snifffmt, data)
 
 		FileSignature =						s[0].decode('utf-8').rstrip('\x00')
@@ -1389,42 +1948,482 @@ class lasreader:
 		'''
 		islas, self.hdr.lasformat = self.getformatVersion()
 		if self.hdr.lasformat == 1.2:
-			data = self.fileptr.read(self.hdr.hdr12len)
+			data = self.read(self.hdr.hdr12len)
 			self.hdr.decodehdr(data)
 		if self.hdr.lasformat == 1.4:
-			data = self.fileptr.read(self.hdr.hdr14len)
+			data = self.read(self.hdr.hdr14len)
 			self.hdr.decodehdr(data)
+			self.readevlrdirectory()
+		self.readvlrdirectory()
+		if self.hdr.compressed:
+			self.openlaz()
+
+	def readvlrdirectory(self):
+		'''
+		read the header of each VLR after the header block, so we know where their payloads are without reading them
+		'''
+		self.vlrs = []
+		currentPosition = self.fileptr.tell()
+		record_struct = struct.Struct(self.hdr.vlrhdr14fmt)
+		position = self.hdr.HeaderSize
+		for i in range(self.hdr.NumberofVariableLengthRecords):
+			self.fileptr.seek(position, 0)
+			data = self.read(record_struct.size)
+			if len(data) < record_struct.size:
+				break
+			s = record_struct.unpack(data)
+			offset = position + record_struct.size
+			self.vlrs.append(lasvlr(s[1].rstrip(b'\x00'), s[2], s[4].rstrip(b'\x00'), s[3], offset))
+			position = offset + s[3]
+		self.fileptr.seek(currentPosition, 0)
+
+	def readevlrdirectory(self):
+		'''
+		read the header of each extended VLR at the end of the file, so we know where their payloads are without reading them
+		'''
+		self.evlrs = []
+		if self.hdr.NumberofExtendedVariableLengthRecords == 0 or self.hdr.StartoffirstExtendedVariableLengthRecord == 0:
+			return
+		currentPosition = self.fileptr.tell()
+		record_struct = struct.Struct(self.hdr.evlrhdr14fmt)
+		position = self.hdr.StartoffirstExtendedVariableLengthRecord
+		for i in range(self.hdr.NumberofExtendedVariableLengthRecords):
+			self.fileptr.seek(position, 0)
+			data = self.read(record_struct.size)
+			if len(data) < record_struct.size:
+				break
+			s = record_struct.unpack(data)
+			offset = position + record_struct.size
+			self.evlrs.append(lasvlr(s[1].rstrip(b'\x00'), s[2], s[4].rstrip(b'\x00'), s[3], offset, None, True))
+			position = offset + s[3]
+		self.fileptr.seek(currentPosition, 0)
+
+	def get_vlr(self, userid, recordid):
+		'''
+		return the payload of the first VLR with the user id and record id, eg get_vlr('LASF_Projection', 2112), or None if there is not one.  only that payload is read from the file
+		'''
+		return self.getvlrdata(self.findvlr(self.vlrs, userid, recordid))
+
+	def get_evlr(self, userid, recordid):
+		'''
+		return the payload of the first extended VLR with the user id and record id, or None if there is not one.  only that payload is read from the file
+		'''
+		return self.getvlrdata(self.findvlr(self.evlrs, userid, recordid))
+
+	def findvlr(self, vlrs, userid, recordid):
+		'''
+		return the first record in the list with the user id and record id, or None
+		'''
+		if isinstance(userid, str):
+			userid = userid.encode('utf-8')
+		for vlr in vlrs:
+			if vlr.userid == userid and vlr.recordid == recordid:
+				return vlr
+		return None
+
+	def getvlrdata(self, vlr):
+		'''
+		read the payload of a VLR or extended VLR, leaving the file position where it was.  in mmap mode this is a memoryview of the mapping
+		'''
+		if vlr is None:
+			return None
+		if vlr.data is not None:
+			return vlr.data
+		currentPosition = self.fileptr.tell()
+		self.fileptr.seek(vlr.offset, 0)
+		data = self.read(vlr.length)
+		self.fileptr.seek(currentPosition, 0)
+		return data
+
+	def waveformdescriptors(self):
+		'''
+		return a dictionary of the waveform packet descriptors, keyed on the wavepacketdescriptorindex used by the points.  the descriptors are VLRs with record ids 100 to 354
+		'''
+		descriptors = {}
+		for vlr in self.vlrs + self.evlrs:
+			if vlr.userid == b'LASF_Spec' and 100 <= vlr.recordid <= 354:
+				descriptors[vlr.recordid - 99] = laswavedescriptor(bytes(self.getvlrdata(vlr)))
+		return descriptors
+
+	def openwaveforms(self):
+		'''
+		memory map the waveform packets.  bit 2 of the global encoding means they are in a .wdp file next to this one, bit 1 means they are inside this file
+		'''
+		if self.waveformview is not None:
+			return
+		if self.hdr.GlobalEncoding & 4:
+			filename = os.path.splitext(self.fileName)[0] + ".wdp"
+			if not os.path.exists(filename):
+				filename = os.path.splitext(self.fileName)[0] + ".WDP"
+			# the offsets are from the start of the file, which begins with the header of the waveform data packet record
+			self.waveformbase = 0
+		elif self.hdr.GlobalEncoding & 2:
+			filename = self.fileName
+			self.waveformbase = self.hdr.StartofWaveformDataPacketRecord
+			if self.waveformbase == 0:
+				vlr = self.findvlr(self.evlrs, b'LASF_Spec', 65535)
+				if vlr is None:
+					raise ValueError("%s says it has internal waveform packets, but there is no waveform data packet record" % (self.fileName))
+				self.waveformbase = vlr.offset - self.hdr.evlrhdr14len
+		else:
+			raise ValueError("%s does not have any waveform packets" % (self.fileName))
+		with open(filename, "rb") as f:
+			self.waveformmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.waveformview = memoryview(self.waveformmap)
+
+	def read_waveforms(self, start=0, count=None, maxgap=65536):
+		'''
+		return the waveform samples for a range of point records, as a list with an array of samples for each point, or None if the point has no waveform.
+		the packets are memory mapped.  they are visited in file order, and packets closer than maxgap bytes are coalesced into one range which is paged in with a single madvise, so we never seek per point
+		'''
+		if count is None:
+			count = self.hdr.Numberofpointrecords - start
+		fields = self.read_fields(["wavepacketdescriptorindex", "byteoffsettowaveformdata", "waveformpacketsize"], start, count)
+		indices = fields["wavepacketdescriptorindex"]
+		offsets = fields["byteoffsettowaveformdata"]
+		sizes = fields["waveformpacketsize"]
+		descriptors = self.waveformdescriptors()
+		self.openwaveforms()
+
+		order = sorted([i for i in range(len(indices)) if indices[i] != 0 and sizes[i] > 0], key=offsets.__getitem__)
+		for rangestart, rangeend in coalesceranges([(offsets[i], offsets[i] + sizes[i]) for i in order], maxgap):
+			self.advisewaveforms(self.waveformbase + rangestart, rangeend - rangestart)
+
+		waveforms = [None] * len(indices)
+		for i in order:
+			descriptor = descriptors.get(indices[i])
+			if descriptor is None:
+				raise ValueError("point %d uses waveform packet descriptor %d, which is not in the file" % (start + i, indices[i]))
+			a = self.waveformbase + offsets[i]
+			waveforms[i] = descriptor.decodesamples(self.waveformview[a:a + sizes[i]])
+		return waveforms
+
+	def advisewaveforms(self, offset, length):
+		'''
+		tell the operating system we are about to read a range of the waveform map, so it is paged in with one large read
+		'''
+		if not hasattr(self.waveformmap, "madvise"):
+			return
+		pagestart = offset - (offset % mmap.PAGESIZE)
+		length = min(length + offset - pagestart, len(self.waveformmap) - pagestart)
+		if length > 0:
+			self.waveformmap.madvise(mmap.MADV_WILLNEED, pagestart, length)
+
+	def openlaz(self):
+		'''
+		prepare to read a LAZ file.  we find the LASzip VLR and read the chunk table, so any chunk of points can be found and decompressed on its own
+		'''
+		if lazrs is None:
+			raise ImportError("reading LAZ files needs the lazrs package.  pip install lazrs")
+		currentPosition = self.fileptr.tell()
+		vlrdata = self.get_vlr(b'laszip encoded', 22204)
+		if vlrdata is None:
+			raise ValueError("%s is compressed but has no LASzip VLR" % (self.fileName))
+		self.lazvlrdata = bytes(vlrdata)
+
+		# the chunk table gives the number of points and bytes in each chunk.  the first chunk starts after the 8 byte offset to the chunk table
+		# lazrs needs a real file object, which the mmap is not, so the table is read through its own handle
+		with open(self.fileName, "rb") as f:
+			f.seek(self.hdr.Offsettopointdata, 0)
+			table = lazrs.read_chunk_table(f, lazrs.LazVlr(self.lazvlrdata))
+		self.lazchunks = []
+		self.lazchunkstarts = []
+		firstpoint = 0
+		offset = self.hdr.Offsettopointdata + 8
+		for pointcount, bytecount in table:
+			# with fixed size chunks the table gives the full chunk size for the last, part filled, chunk
+			pointcount = min(pointcount, self.hdr.Numberofpointrecords - firstpoint)
+			self.lazchunks.append((firstpoint, pointcount, offset, bytecount))
+			self.lazchunkstarts.append(firstpoint)
+			firstpoint += pointcount
+			offset += bytecount
+		self.lazcache = (-1, b"")
+		self.pointposition = 0
+		self.fileptr.seek(currentPosition, 0)
+
+	def readcompressedpointbytes(self, recordsToRead):
+		'''
+		decompress the raw bytes of the required number of records from a LAZ file, starting at the current point position.
+		each LASzip chunk is independent, so we only decompress the chunks we need.  if we need several, they are decompressed in parallel in a pool of processes
+		'''
+		start = self.pointposition
+		end = min(start + recordsToRead, self.hdr.Numberofpointrecords)
+		if end <= start or len(self.lazchunks) == 0:
+			return b""
+		recordlength = self.hdr.getpointstruct().size
+		first = bisect.bisect_right(self.lazchunkstarts, start) - 1
+		last = bisect.bisect_right(self.lazchunkstarts, end - 1) - 1
+
+		needed = [i for i in range(first, last + 1) if i != self.lazcache[0]]
+		decoded = {}
+		if self.lazcache[0] >= first and self.lazcache[0] <= last:
+			decoded[self.lazcache[0]] = self.lazcache[1]
+		if len(needed) > 1 and self.workers > 1:
+			if self.pool is None:
+				self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+			futures = [self.pool.submit(decompresslazchunk, self.readlazchunk(i), self.lazvlrdata, self.lazchunks[i][1], recordlength) for i in needed]
+			for i, future in zip(needed, futures):
+				decoded[i] = future.result()
+		else:
+			for i in needed:
+				decoded[i] = decompresslazchunk(self.readlazchunk(i), self.lazvlrdata, self.lazchunks[i][1], recordlength)
+
+		parts = []
+		for i in range(first, last + 1):
+			chunkstart = self.lazchunks[i][0]
+			a = max(start, chunkstart) - chunkstart
+			b = min(end, chunkstart + self.lazchunks[i][1]) - chunkstart
+			parts.append(decoded[i][a * recordlength:b * recordlength])
+		# keep the last chunk, as the next read usually carries on from it
+		self.lazcache = (last, decoded[last])
+		self.pointposition = end
+		if len(parts) == 1:
+			return parts[0]
+		return b"".join(parts)
+
+	def readlazchunk(self, index):
+		'''
+		return the compressed bytes of a LAZ chunk
+		'''
+		firstpoint, pointcount, offset, bytecount = self.lazchunks[index]
+		self.fileptr.seek(offset, 0)
+		return bytes(self.read(bytecount))
 
 	def unpackpoints(self, records):
 		'''
 		the points read into the list need unpacking into the real world useful data
 		'''
-		for r in records:
-			self.x.append((r[0] * self.hdr.Xscalefactor) + self.hdr.Xoffset)
-			self.y.append((r[1] * self.hdr.Yscalefactor) + self.hdr.Yoffset)
-			self.z.append((r[2] * self.hdr.Zscalefactor) + self.hdr.Zoffset)
+		self.appendrecords(records, self.hdr)
+
+	def readpoints(self, recordsToRead=1, chunksize=1000000):
+		'''
+		read and unpack the required number of records straight into the point arrays, including the bit fields of the flag bytes.
+		the records are decoded a chunk at a time straight from the raw bytes, so we never hold the whole point block or any decoded tuples in memory
+		'''
+		recordlength = self.hdr.getpointstruct().size
+		while recordsToRead > 0:
+			data = self.readpointbytes(min(chunksize, recordsToRead))
+			if len(data) == 0:
+				break
+			self.appendpointbytes(data, self.hdr)
+			recordsToRead -= len(data) // recordlength
 
 	def readpointrecords(self, recordsToRead=1):
 		'''
-		read the required number of records from the file
+		read the required number of records from the file.
+		the block is read in one call and decoded in a single pass using a precompiled struct, so we do not slice the data or re-parse the format for every record
 		'''
-		data = self.fileptr.read(self.supportedformats[self.hdr.PointDataRecordFormat][1] * recordsToRead)
-		result = []
-		i = 0
-		for r in range(recordsToRead):
-			j = i + self.supportedformats[self.hdr.PointDataRecordFormat][1]
-			result.append(struct.unpack(self.supportedformats[self.hdr.PointDataRecordFormat][0], data[i:j]))
-			i = j
-		
+		s = self.hdr.getpointstruct()
+		return list(s.iter_unpack(self.readpointbytes(recordsToRead)))
+
+	def read_fields(self, names, start=0, count=None, scaled=True):
+		'''
+		read only the requested fields for a range of point records, eg read_fields(["z", "classification"], 0, 1000).
+		each field is extracted from the raw records at its known byte offset by strided access, so fields we do not ask for are never decoded.
+		bit field attributes such as returnnumber or scannerchannel can be asked for by name, as can the raw flag bytes ('flags', or 'flag1' and 'flag2').
+		returns a dictionary of typed arrays keyed on the field name.  x, y and z are scaled into real world values unless scaled is False.
+		the file pointer is left after the last record read.
+		'''
+		if count is None:
+			count = self.hdr.Numberofpointrecords - start
+		self.seekPointRecord(start)
+		return self.decodefields(self.readpointbytes(count), names, scaled)
+
+	def decodefields(self, data, names, scaled=True):
+		'''
+		extract the named fields from a block of raw point records.  see read_fields()
+		'''
+		return decodepointfields(data, self.hdr, names, scaled)
+
+	def iter_chunks(self, chunk_size=1000000, fields=None):
+		'''
+		generator which yields the point records a chunk at a time as laspoints objects, so peak memory is set by chunk_size rather than the size of the file.
+		reading starts at the current point record and each chunk carries on from the current file position, so if you call seekPointRecordStart() the next chunk starts again from the first record.
+		if fields is a list of field names, only those fields are decoded into each chunk.  see read_fields()
+		'''
+		for data in self.iter_pointbytes(chunk_size):
+			chunk = laspoints()
+			if fields is None:
+				chunk.appendpointbytes(data, self.hdr)
+			else:
+				for name, column in self.decodefields(data, fields).items():
+					setattr(chunk, name, column)
+			yield chunk
+
+	def iter_pointbytes(self, chunk_size=1000000, start=None, count=None):
+		'''
+		generator which yields the raw bytes of the point records, chunk_size complete records at a time, as returned by readpointbytes().
+		if start is None reading carries on from the current point record, like iter_chunks(), otherwise it starts at record start.  if count is given at most count records are read, otherwise we read to the last record
+		'''
+		if start is not None:
+			self.seekPointRecord(start)
+		elif not self.hdr.compressed and self.fileptr.tell() < self.hdr.Offsettopointdata:
+			self.seekPointRecordStart()
+		recordlength = self.hdr.getpointstruct().size
+		done = 0
+		while count is None or done < count:
+			n = min(chunk_size, self.hdr.Numberofpointrecords - self.tellPointRecord())
+			if count is not None:
+				n = min(n, count - done)
+			if n <= 0:
+				return
+			data = self.readpointbytes(n)
+			if len(data) == 0:
+				return
+			done += len(data) // recordlength
+			yield data
+
+	def read_parallel(self, workers=None, fields=None, scaled=True):
+		'''
+		read every point record, decoding ranges of records in parallel in a pool of processes, and return them as a laspoints object.
+		each field is decoded straight into a shared memory buffer, so the columns never have to be pickled back from the workers.
+		if fields is a list of field names, only those fields are decoded.  see read_fields()
+		'''
+		if workers is None:
+			workers = self.workers
+		names = fields if fields is not None else self.hdr.getpointattributes()
+		total = self.hdr.Numberofpointrecords
+		result = laspoints()
+		if total == 0:
+			return result
+
+		# decode the first record to find the type of each column
+		self.seekPointRecordStart()
+		sample = self.decodefields(self.readpointbytes(1), names, scaled)
+		self.seekPointRecordStart()
+
+		buffers = {}
+		try:
+			for name in names:
+				buffers[name] = shared_memory.SharedMemory(create=True, size=total * sample[name].itemsize)
+			buffernames = dict([(name, buffer.name) for name, buffer in buffers.items()])
+			with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+				futures = [pool.submit(decodepointrange, self.fileName, names, scaled, start, count, buffernames) for start, count in self.pointranges(workers)]
+				for future in futures:
+					future.result()
+			for name in names:
+				column = array.array(sample[name].typecode)
+				column.frombytes(buffers[name].buf[:total * column.itemsize])
+				setattr(result, name, column)
+		finally:
+			for buffer in buffers.values():
+				buffer.close()
+				buffer.unlink()
+		return result
+
+	def read_where(self, classification=None, returnnumber=None, pointsourceid=None, gpstime=None, lastreturn=False, fields=None, scaled=True, chunk_size=1000000):
+		'''
+		read just the point records which match simple predicates, eg read_where(classification=2) for the ground or read_where(lastreturn=True).
+		the predicates are tested on the raw bytes of each chunk of records, see matchrecords(), and only the records which match are decoded.
+		returns a laspoints object.  if fields is a list of field names, only those fields are decoded.  see read_fields()
+		'''
+		result = laspoints()
+		columns = {}
+		names = fields if fields is not None else self.hdr.getpointattributes()
+		recordlength = self.hdr.getpointstruct().size
+		for data in self.iter_pointbytes(chunk_size, 0):
+			count = len(data) // recordlength
+			mask = matchrecords(data, self.hdr, classification, returnnumber, pointsourceid, gpstime, lastreturn)
+			selected = selectrecords(data, recordlength, itertools.compress(range(count), mask))
+			if len(selected) == 0:
+				continue
+			for name, column in self.decodefields(selected, names, scaled).items():
+				if name in columns:
+					columns[name].extend(column)
+				else:
+					columns[name] = column
+		for name, column in columns.items():
+			setattr(result, name, column)
+		return result
+
+	def pointranges(self, parts):
+		'''
+		split the point records into about the given number of (start, count) ranges.  for LAZ files the ranges follow the chunks, so no chunk is decompressed twice
+		'''
+		total = self.hdr.Numberofpointrecords
+		if self.hdr.compressed:
+			starts = self.lazchunkstarts
+			step = max(1, math.ceil(len(starts) / parts))
+			boundaries = starts[::step] + [total]
+		else:
+			step = max(1, math.ceil(total / parts))
+			boundaries = list(range(0, total, step)) + [total]
+		return [(boundaries[i], boundaries[i + 1] - boundaries[i]) for i in range(len(boundaries) - 1)]
+
+	def readpointbytes(self, recordsToRead=1):
+		'''
+		read the raw bytes of the required number of records from the file without decoding them.  in mmap mode this is a memoryview of the mapping.
+		we never read past the last point record, so extended VLRs or waveform data after the points block are not returned as points.
+		LAZ files are decompressed on the fly
+		'''
+		if self.hdr.compressed:
+			return self.readcompressedpointbytes(recordsToRead)
+		recordlength = self.hdr.getpointstruct().size
+		recordsToRead = max(0, min(recordsToRead, self.hdr.Numberofpointrecords - self.tellPointRecord()))
+		data = self.read(recordlength * recordsToRead)
+		# if the file is truncated, only return the complete records
+		remainder = len(data) % recordlength
+		if remainder:
+			data = data[:len(data) - remainder]
+		return data
+
+	def buildindex(self, cellsize=None, save=True):
+		'''
+		build a spatial index over the point records and, if save is True, write it to a sidecar file next to the las file so query_bbox can use it next time
+		'''
+		self.index = lasindex()
+		self.index.build(self, cellsize)
+		if save:
+			self.index.save(lasindex.indexfilename(self.fileName))
+		return self.index
+
+	def loadindex(self):
+		'''
+		load the spatial index from the sidecar file if there is one and it matches this file.  returns None if there is no usable index
+		'''
+		if self.index is None:
+			indexfilename = lasindex.indexfilename(self.fileName)
+			# only fingerprint the las file if there is an index to check it against
+			if os.path.isfile(indexfilename):
+				index = lasindex()
+				if index.load(indexfilename, self.hdr.Numberofpointrecords, index.filefingerprint(self.fileName, self.hdr)):
+					self.index = index
+		return self.index
+
+	def query_bbox(self, minx, miny, maxx, maxy, chunk_size=1000000):
+		'''
+		return a laspoints object holding every point inside the bounding box.
+		if the file has a spatial index (see buildindex) only the point record ranges in the overlapping cells are read, otherwise every record is scanned.
+		each candidate range is filtered on the raw integer coordinates, and only the records inside the box are decoded
+		'''
+		if self.loadindex() is not None:
+			ranges = self.index.query(minx, miny, maxx, maxy)
+		else:
+			ranges = [(0, self.hdr.Numberofpointrecords)]
+
+		# convert the box into raw integer coordinates so we can test the records without scaling them
+		rawminx = math.ceil((minx - self.hdr.Xoffset) / self.hdr.Xscalefactor)
+		rawmaxx = math.floor((maxx - self.hdr.Xoffset) / self.hdr.Xscalefactor)
+		rawminy = math.ceil((miny - self.hdr.Yoffset) / self.hdr.Yscalefactor)
+		rawmaxy = math.floor((maxy - self.hdr.Yoffset) / self.hdr.Yscalefactor)
+
+		recordlength = self.hdr.getpointstruct().size
+		result = laspoints()
+		for start, end in ranges:
+			for data in self.iter_pointbytes(chunk_size, start, end - start):
+				columns = self.decodefields(data, ["x", "y"], scaled=False)
+				inside = [i for i, (x, y) in enumerate(zip(columns["x"], columns["y"])) if rawminx <= x <= rawmaxx and rawminy <= y <= rawmaxy]
+				if len(inside) > 0:
+					result.appendpointbytes(selectrecords(data, recordlength, inside), self.hdr)
 		return result
 
 	def readvariablelengthrecord(self):
 		'''
-		read a variable length record from the file
+		read the variable length record at the current file position into the vlr attributes.  use vlrs and get_vlr() to go straight to the record you need
 		'''
 		vlrhdr14fmt = "<H16sHH32s"
 		vlrhdr14len = struct.calcsize(vlrhdr14fmt)
-		data = self.fileptr.read(vlrhdr14len)
+		data = self.read(vlrhdr14len)
 		s = struct.unpack(vlrhdr14fmt, data)
 
 		self.vlrReserved				   = s[0]
@@ -1434,9 +2433,810 @@ class lasreader:
 		self.vlrDescription				= s[4]
 
 		# now read the variable data
-		self.vlrdata = self.fileptr.read(self.vlrRecordLengthAfterHeader)
-		print (self.vlrdata)
+		self.vlrdata = self.read(self.vlrRecordLengthAfterHeader)
+
+
+###############################################################################
+def coalesceranges(ranges, maxgap):
+	'''
+	merge a list of (start, end) byte ranges, sorted on start, wherever the gap between them is no more than maxgap
+	'''
+	merged = []
+	for start, end in ranges:
+		if len(merged) > 0 and start - merged[-1][1] <= maxgap:
+			merged[-1][1] = max(merged[-1][1], end)
+		else:
+			merged.append([start, end])
+	return merged
+
+def decodepointrange(filename, names, scaled, start, count, buffernames, blocksize=1000000):
+	'''
+	decode the named fields of a range of point records into the shared memory buffers of lasreader.read_parallel().
+	this and the other worker functions below are module level functions, so they can be run in a pool of processes
+	'''
+	reader = lasreader(filename, workers=1)
+	buffers = dict([(name, shared_memory.SharedMemory(name=buffername)) for name, buffername in buffernames.items()])
+	try:
+		reader.readhdr()
+		recordlength = reader.hdr.getpointstruct().size
+		done = 0
+		for data in reader.iter_pointbytes(blocksize, start, count):
+			for name, column in reader.decodefields(data, names, scaled).items():
+				offset = (start + done) * column.itemsize
+				with memoryview(column) as view:
+					buffers[name].buf[offset:offset + len(view) * column.itemsize] = view.cast('B')
+			done += len(data) // recordlength
+	finally:
+		for buffer in buffers.values():
+			buffer.close()
+		reader.close()
+
+def compresslazchunk(vlrdata, data):
+	'''
+	compress a block of point records into a single LASzip chunk.  lazrs writes a complete points block, so we keep just the chunk between the 8 byte offset to the chunk table and the table itself
+	'''
+	block = lazrs.compress_points(lazrs.LazVlr(vlrdata), data, False)
+	tableoffset = struct.unpack_from("<q", block, 0)[0]
+	return block[8:tableoffset]
+
+def decompresslazchunk(data, vlrdata, pointcount, recordlength):
+	'''
+	decompress a single LASzip chunk into raw point records
+	'''
+	out = bytearray(pointcount * recordlength)
+	lazrs.decompress_points_with_chunk_table(data, vlrdata, out, [(pointcount, len(data))])
+	return bytes(out)
+
+###############################################################################
+class lasindex:
+	'''
+	a spatial index over the point records of a las file, saved as a sidecar file next to the las file.
+	the bounding box of the file is divided into a grid of square cells, and each cell holds the list of contiguous point record intervals [start, end) which fall into it.
+	a bounding box query only needs to read the intervals of the cells it overlaps.
+	the index stores a fingerprint of the las file it was built from, and is rejected if the file has changed since
+	'''
+	def __init__(self):
+		self.signature = b'LIDX'
+		self.version = 2
+		self.hdrfmt = "<4sHQQqQHIdddIII"
+		self.cellfmt = "<II"
+		# the number of point record bytes at each end of the file included in the fingerprint checksum
+		self.fingerprintbytes = 65536
+
+		self.pointcount = 0
+		# file size, modification time in ns, offset to point data, record length and checksum of the file the index was built from
+		self.fingerprint = (0, 0, 0, 0, 0)
+		self.minx = 0
+		self.miny = 0
+		self.cellsize = 1
+		self.ncols = 1
+		self.nrows = 1
+		# cell number -> array of interleaved interval starts and ends
+		self.cells = {}
+
+	def indexfilename(lasfilename):
+		'''
+		return the name of the sidecar index file for a las file
+		'''
+		return os.path.splitext(lasfilename)[0] + ".lasidx"
+	indexfilename = staticmethod(indexfilename)
+
+	def filefingerprint(self, filename, hdr):
+		'''
+		return a tuple which identifies the exact contents of a las file: its size, modification time, offset to point data, record length and a crc32 of the header block and of the first and last point records.
+		the checksum catches a file which was rewritten, eg sorted, with the same size and a preserved modification time
+		'''
+		stat = os.stat(filename)
+		recordlength = hdr.PointDataRecordLength
+		pointbytes = hdr.Numberofpointrecords * recordlength
+		with open(filename, 'rb') as f:
+			crc = zlib.crc32(f.read(hdr.HeaderSize))
+			f.seek(hdr.Offsettopointdata, 0)
+			crc = zlib.crc32(f.read(min(pointbytes, self.fingerprintbytes)), crc)
+			if pointbytes > self.fingerprintbytes:
+				f.seek(hdr.Offsettopointdata + pointbytes - self.fingerprintbytes, 0)
+				crc = zlib.crc32(f.read(self.fingerprintbytes), crc)
+		return (stat.st_size, stat.st_mtime_ns, hdr.Offsettopointdata, recordlength, crc)
+
+	def build(self, reader, cellsize=None, maxgap=100, chunk_size=1000000):
+		'''
+		build the index by streaming the x and y of every record from the reader.
+		if cellsize is None it is chosen so there are on average a few thousand points in each cell.
+		intervals in a cell separated by maxgap points or fewer are merged, as reading a few extra points is cheaper than another seek
+		'''
+		hdr = reader.hdr
+		self.pointcount = hdr.Numberofpointrecords
+		self.fingerprint = self.filefingerprint(reader.fileName, hdr)
+		self.minx = hdr.MinX
+		self.miny = hdr.MinY
+		width = max(hdr.MaxX - hdr.MinX, hdr.MaxY - hdr.MinY)
+		if cellsize is None:
+			cellsperside = max(1, min(1024, int(math.sqrt(self.pointcount / 5000))))
+			cellsize = width / cellsperside
+		self.cellsize = cellsize if cellsize > 0 else 1
+		self.ncols = int((hdr.MaxX - hdr.MinX) / self.cellsize) + 1
+		self.nrows = int((hdr.MaxY - hdr.MinY) / self.cellsize) + 1
+
+		intervals = {}
+		index = 0
+		previouscell = -1
+		current = None
+		reader.seekPointRecordStart()
+		for chunk in reader.iter_chunks(chunk_size, ["x", "y"]):
+			for x, y in zip(chunk.x, chunk.y):
+				cell = self.cellnumber(x, y)
+				if cell != previouscell:
+					current = intervals.get(cell)
+					if current is None:
+						current = intervals[cell] = [index, index + 1]
+					elif index - current[-1] <= maxgap:
+						current[-1] = index + 1
+					else:
+						current.append(index)
+						current.append(index + 1)
+					previouscell = cell
+				else:
+					current[-1] = index + 1
+				index += 1
+
+		self.cells = {}
+		for cell, cellintervals in intervals.items():
+			self.cells[cell] = array.array('Q', cellintervals)
+
+	def cellnumber(self, x, y):
+		'''
+		return the number of the cell holding a point, clamped to the grid
+		'''
+		col = min(max(int((x - self.minx) / self.cellsize), 0), self.ncols - 1)
+		row = min(max(int((y - self.miny) / self.cellsize), 0), self.nrows - 1)
+		return (row * self.ncols) + col
+
+	def query(self, minx, miny, maxx, maxy):
+		'''
+		return a sorted list of non overlapping (start, end) point record intervals which together hold every point in the bounding box.
+		the intervals may also hold points outside the box, so the caller still needs to test each point
+		'''
+		mincol = int((minx - self.minx) / self.cellsize)
+		maxcol = int((maxx - self.minx) / self.cellsize)
+		minrow = int((miny - self.miny) / self.cellsize)
+		maxrow = int((maxy - self.miny) / self.cellsize)
+		if maxcol < 0 or maxrow < 0 or mincol >= self.ncols or minrow >= self.nrows:
+			return []
+
+		found = []
+		for row in range(max(minrow, 0), min(maxrow, self.nrows - 1) + 1):
+			for col in range(max(mincol, 0), min(maxcol, self.ncols - 1) + 1):
+				cellintervals = self.cells.get((row * self.ncols) + col)
+				if cellintervals is not None:
+					found.extend(zip(cellintervals[0::2], cellintervals[1::2]))
+		found.sort()
+
+		# coalesce overlapping and touching intervals so each part of the file is read once
+		merged = []
+		for start, end in found:
+			if len(merged) > 0 and start <= merged[-1][1]:
+				if end > merged[-1][1]:
+					merged[-1][1] = end
+			else:
+				merged.append([start, end])
+		return [(start, end) for start, end in merged]
+
+	def save(self, filename):
+		'''
+		write the index to disc
+		'''
+		with open(filename, 'wb') as f:
+			f.write(struct.pack(self.hdrfmt, self.signature, self.version, self.pointcount, *self.fingerprint, self.minx, self.miny, self.cellsize, self.ncols, self.nrows, len(self.cells)))
+			for cell in sorted(self.cells):
+				cellintervals = self.cells[cell]
+				f.write(struct.pack(self.cellfmt, cell, len(cellintervals) // 2))
+				if sys.byteorder == 'big':
+					cellintervals = array.array('Q', cellintervals)
+					cellintervals.byteswap()
+				f.write(cellintervals.tobytes())
+
+	def load(self, filename, pointcount=None, fingerprint=None):
+		'''
+		read the index from disc.  returns False if there is no index file, if pointcount is given and the index was built for a different number of points, or if fingerprint is given and the index was built from a different file.  see filefingerprint()
+		'''
+		if not os.path.isfile(filename):
+			return False
+		with open(filename, 'rb') as f:
+			data = f.read()
+		hdrlen = struct.calcsize(self.hdrfmt)
+		s = struct.unpack_from(self.hdrfmt, data, 0)
+		if s[0] != self.signature or s[1] != self.version:
+			return False
+		if pointcount is not None and s[2] != pointcount:
+			return False
+		if fingerprint is not None and tuple(s[3:8]) != tuple(fingerprint):
+			return False
+		self.pointcount = s[2]
+		self.fingerprint = tuple(s[3:8])
+		self.minx, self.miny, self.cellsize, self.ncols, self.nrows = s[8:13]
+
+		self.cells = {}
+		offset = hdrlen
+		celllen = struct.calcsize(self.cellfmt)
+		for _ in range(s[13]):
+			cell, count = struct.unpack_from(self.cellfmt, data, offset)
+			offset += celllen
+			cellintervals = array.array('Q')
+			cellintervals.frombytes(data[offset:offset + (count * 16)])
+			if sys.byteorder == 'big':
+				cellintervals.byteswap()
+			self.cells[cell] = cellintervals
+			offset += count * 16
+		return True
+
+###############################################################################
+class lascatalog:
+	'''
+	a catalog of the las and laz files in a folder, so we can find the tiles we need without opening every file.
+	only the fixed header block of each file is read, in a pool of threads.  the summaries are kept in a cache file in the folder, keyed on path, modification time and size, so on the next scan only new or changed files are read
+	'''
+	def __init__(self, folder, cachefilename=None, workers=16):
+		self.folder = folder
+		if cachefilename is None:
+			cachefilename = os.path.join(folder, ".lascatalog.json")
+		self.cachefilename = cachefilename
+		self.workers = workers
+		self.version = 1
+		# path -> dictionary summarising the header of the file
+		self.tiles = {}
+
+	def scan(self):
+		'''
+		walk the folder for las and laz files and read the header of any file which is not already in the cache, then save the cache if anything changed
+		'''
+		cached = self.loadcache()
+		found = {}
+		for root, dirs, files in os.walk(self.folder):
+			for name in files:
+				if os.path.splitext(name)[1].lower() in (".las", ".laz"):
+					path = os.path.abspath(os.path.join(root, name))
+					st = os.stat(path)
+					found[path] = (st.st_mtime, st.st_size)
+
+		self.tiles = {}
+		stale = []
+		for path, (mtime, size) in found.items():
+			summary = cached.get(path)
+			if summary is not None and summary["mtime"] == mtime and summary["size"] == size:
+				self.tiles[path] = summary
+			else:
+				stale.append(path)
+
+		if len(stale) > 0:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+				for path, summary in zip(stale, pool.map(readheadersummary, stale)):
+					if summary is not None:
+						summary["mtime"], summary["size"] = found[path]
+						self.tiles[path] = summary
+		if len(stale) > 0 or len(self.tiles) != len(cached):
+			self.savecache()
+		return self.tiles
+
+	def query_bbox(self, minx, miny, maxx, maxy):
+		'''
+		return the paths of the files whose bounding box intersects the box
+		'''
+		return sorted([path for path, t in self.tiles.items() if t["minx"] <= maxx and t["maxx"] >= minx and t["miny"] <= maxy and t["maxy"] >= miny])
+
+	def bbox(self):
+		'''
+		return the bounding box of all the files as (minx, miny, maxx, maxy)
+		'''
+		if len(self.tiles) == 0:
+			return None
+		t = self.tiles.values()
+		return (min([s["minx"] for s in t]), min([s["miny"] for s in t]), max([s["maxx"] for s in t]), max([s["maxy"] for s in t]))
+
+	def pointcount(self):
+		'''
+		return the total number of points in all the files
+		'''
+		return sum([s["pointcount"] for s in self.tiles.values()])
+
+	def loadcache(self):
+		'''
+		return the summaries from the cache file, or an empty dictionary if there is no usable cache
+		'''
+		try:
+			with open(self.cachefilename, "r") as f:
+				cache = json.load(f)
+		except (OSError, ValueError):
+			return {}
+		if cache.get("version") != self.version:
+			return {}
+		return cache.get("tiles", {})
+
+	def savecache(self):
+		'''
+		write the summaries to the cache file.  we write to a temporary file and rename it, so a crash never leaves a half written cache
+		'''
+		temporary = self.cachefilename + ".tmp"
+		with open(temporary, "w") as f:
+			json.dump({"version": self.version, "tiles": self.tiles}, f)
+		os.replace(temporary, self.cachefilename)
+
+def readheadersummary(filename):
+	'''
+	read just the fixed header block of a las or laz file and return a dictionary of its version, point format, point count and bounding box, or None if it is not a las file
+	'''
+	hdr = lashdr()
+	with open(filename, "rb") as f:
+		data = f.read(hdr.hdr14len)
+	if len(data) < hdr.hdr12len or data[:4] != b'LASF':
+		return None
+	# versions before 1.4 share the 1.2 layout for the fields we need
+	if data[25] >= 4 and len(data) >= hdr.hdr14len:
+		hdr.lasformat = 1.4
+		hdr.decodehdr(data[:hdr.hdr14len])
+	else:
+		hdr.lasformat = 1.2
+		hdr.decodehdr(data[:hdr.hdr12len])
+	return {
+		"version": "%d.%d" % (data[24], data[25]),
+		"pointformat": hdr.PointDataRecordFormat,
+		"pointcount": hdr.Numberofpointrecords,
+		"compressed": hdr.compressed,
+		"minx": hdr.MinX,
+		"miny": hdr.MinY,
+		"minz": hdr.MinZ,
+		"maxx": hdr.MaxX,
+		"maxy": hdr.MaxY,
+		"maxz": hdr.MaxZ,
+	}
+
+###############################################################################
+class lasgrid:
+	'''
+	a raster of per cell statistics of z, accumulated a batch of points at a time so files larger than memory can be gridded.
+	each statistic is a typed array with one value per cell: the count, sum, minimum and maximum of z, the count and sum of the last returns, and optionally the inverse distance weighted sums.
+	grids of the same extent which were accumulated from different points can be merged, so ranges of points can be gridded in parallel and then reduced
+	'''
+	def __init__(self, minx, miny, ncols, nrows, cellsize, idw=False, power=2.0):
+		self.minx = minx
+		self.miny = miny
+		self.ncols = ncols
+		self.nrows = nrows
+		self.cellsize = cellsize
+		self.idw = idw
+		self.power = power
+		cells = ncols * nrows
+		# row 0 is the most southerly row
+		self.count = array.array('I', bytes(4 * cells))
+		self.sumz = array.array('d', bytes(8 * cells))
+		self.minz = array.array('d', [math.inf]) * cells
+		self.maxz = array.array('d', [-math.inf]) * cells
+		self.lastcount = array.array('I', bytes(4 * cells))
+		self.lastsumz = array.array('d', bytes(8 * cells))
+		if idw:
+			self.idwsumwz = array.array('d', bytes(8 * cells))
+			self.idwsumw = array.array('d', bytes(8 * cells))
+
+	def update(self, xs, ys, zs, returnnumbers=None, numberreturns=None):
+		'''
+		add a batch of points.  if the return numbers and numbers of returns are given, the last returns are gathered too
+		'''
+		minx, miny, cellsize, ncols, nrows = self.minx, self.miny, self.cellsize, self.ncols, self.nrows
+		count, sumz, minz, maxz = self.count, self.sumz, self.minz, self.maxz
+		for i, (x, y, z) in enumerate(zip(xs, ys, zs)):
+			col = int((x - minx) // cellsize)
+			row = int((y - miny) // cellsize)
+			if col < 0 or col >= ncols or row < 0 or row >= nrows:
+				continue
+			cell = (row * ncols) + col
+			count[cell] += 1
+			sumz[cell] += z
+			if z < minz[cell]:
+				minz[cell] = z
+			if z > maxz[cell]:
+				maxz[cell] = z
+			if returnnumbers is not None and returnnumbers[i] == numberreturns[i]:
+				self.lastcount[cell] += 1
+				self.lastsumz[cell] += z
+			if self.idw:
+				# weight by the distance to the centre of the cell
+				dx = x - (minx + (col + 0.5) * cellsize)
+				dy = y - (miny + (row + 0.5) * cellsize)
+				w = 1.0 / max(math.hypot(dx, dy), cellsize * 0.001) ** self.power
+				self.idwsumwz[cell] += w * z
+				self.idwsumw[cell] += w
+
+	def merge(self, other):
+		'''
+		add the statistics of another grid of the same extent into this one
+		'''
+		if (other.minx, other.miny, other.ncols, other.nrows, other.cellsize) != (self.minx, self.miny, self.ncols, self.nrows, self.cellsize):
+			raise ValueError("only grids with the same extent can be merged")
+		for cell in range(self.ncols * self.nrows):
+			if other.count[cell] == 0:
+				continue
+			self.count[cell] += other.count[cell]
+			self.sumz[cell] += other.sumz[cell]
+			self.minz[cell] = min(self.minz[cell], other.minz[cell])
+			self.maxz[cell] = max(self.maxz[cell], other.maxz[cell])
+			self.lastcount[cell] += other.lastcount[cell]
+			self.lastsumz[cell] += other.lastsumz[cell]
+			if self.idw:
+				self.idwsumwz[cell] += other.idwsumwz[cell]
+				self.idwsumw[cell] += other.idwsumw[cell]
+
+	def values(self, statistic="mean", nodata=-9999.0):
+		'''
+		return an array with the value of a statistic for every cell: 'count', 'min', 'max', 'mean', 'last' (the mean z of the last returns) or 'idw'.  cells with no points are nodata
+		'''
+		cells = range(self.ncols * self.nrows)
+		if statistic == "count":
+			return array.array('d', self.count)
+		if statistic == "min":
+			return array.array('d', [self.minz[c] if self.count[c] else nodata for c in cells])
+		if statistic == "max":
+			return array.array('d', [self.maxz[c] if self.count[c] else nodata for c in cells])
+		if statistic == "mean":
+			return array.array('d', [self.sumz[c] / self.count[c] if self.count[c] else nodata for c in cells])
+		if statistic == "last":
+			return array.array('d', [self.lastsumz[c] / self.lastcount[c] if self.lastcount[c] else nodata for c in cells])
+		if statistic == "idw":
+			if not self.idw:
+				raise ValueError("the grid was not built with idw=True")
+			return array.array('d', [self.idwsumwz[c] / self.idwsumw[c] if self.count[c] else nodata for c in cells])
+		raise ValueError("statistic must be 'count', 'min', 'max', 'mean', 'last' or 'idw'")
+
+	def writeasciigrid(self, filename, statistic="mean", nodata=-9999.0):
+		'''
+		write a statistic as an ESRI ASCII grid, which most GIS packages can open.  the rows are written from north to south
+		'''
+		values = self.values(statistic, nodata)
+		with open(filename, "w") as f:
+			f.write("ncols %d\n" % (self.ncols))
+			f.write("nrows %d\n" % (self.nrows))
+			f.write("xllcorner %.6f\n" % (self.minx))
+			f.write("yllcorner %.6f\n" % (self.miny))
+			f.write("cellsize %.6f\n" % (self.cellsize))
+			f.write("NODATA_value %g\n" % (nodata))
+			for row in range(self.nrows - 1, -1, -1):
+				f.write(" ".join(["%.3f" % (v) for v in values[row * self.ncols:(row + 1) * self.ncols]]) + "\n")
+
+def gridlasfile(infilename, outfilename=None, cellsize=1.0, statistic="mean", workers=1, idw=False, power=2.0, chunk_size=1000000):
+	'''
+	grid the z values of a las or laz file into a raster of cellsize square cells, and write a statistic to an ESRI ASCII grid if outfilename is given.  see lasgrid.values() for the statistics.
+	the points are streamed in chunks.  with more than one worker, ranges of points are gridded in a pool of processes and the grids are merged at the end.  returns the lasgrid
+	'''
+	reader = lasreader(infilename)
+	reader.readhdr()
+	hdr = reader.hdr
+	# line the cells up on multiples of the cell size
+	minx = math.floor(hdr.MinX / cellsize) * cellsize
+	miny = math.floor(hdr.MinY / cellsize) * cellsize
+	ncols = int((hdr.MaxX - minx) // cellsize) + 1
+	nrows = int((hdr.MaxY - miny) // cellsize) + 1
+	ranges = reader.pointranges(workers) if hdr.Numberofpointrecords > 0 else []
+	reader.close()
+	if statistic == "idw":
+		idw = True
+
+	if workers > 1 and len(ranges) > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+			futures = [pool.submit(gridpointrange, infilename, minx, miny, ncols, nrows, cellsize, idw, power, start, count, chunk_size) for start, count in ranges]
+			grid = futures[0].result()
+			for future in futures[1:]:
+				grid.merge(future.result())
+	else:
+		grid = gridpointrange(infilename, minx, miny, ncols, nrows, cellsize, idw, power, 0, hdr.Numberofpointrecords, chunk_size)
+
+	if outfilename is not None:
+		grid.writeasciigrid(outfilename, statistic)
+	return grid
+
+def gridpointrange(filename, minx, miny, ncols, nrows, cellsize, idw, power, start, count, chunk_size=1000000):
+	'''
+	grid a range of the point records of a file, for gridlasfile()
+	'''
+	grid = lasgrid(minx, miny, ncols, nrows, cellsize, idw, power)
+	reader = lasreader(filename, workers=1)
+	reader.readhdr()
+	for data in reader.iter_pointbytes(chunk_size, start, count):
+		columns = reader.decodefields(data, ["x", "y", "z", "returnnumber", "numberreturns"])
+		grid.update(columns["x"], columns["y"], columns["z"], columns["returnnumber"], columns["numberreturns"])
+	reader.close()
+	return grid
+
+###############################################################################
+def convertlasfile(infilename, outfilename, lasformat=1.4, pointformat=None, chunk_size=1000000, wkt=None):
+	'''
+	convert a las or laz file to another las version and point format, eg 1.2 format 3 to 1.4 format 7.
+	the point records are converted chunk by chunk on their raw bytes, see convertpointrecords(), so the coordinates keep their integer values and the scale and offset are unchanged.
+	if pointformat is None we keep the point format, or for las 1.2 use the nearest of formats 0-3.
+	point formats 6-10 must describe the coordinate system in WKT.  we cannot convert GeoTIFF keys to WKT, so if the source only has GeoTIFF keys pass the WKT of its coordinate system as wkt, which replaces the GeoTIFF VLRs.  otherwise a ValueError is raised
+	'''
+	reader = lasreader(infilename)
+	reader.readhdr()
+	srchdr = reader.hdr
+	if pointformat is None:
+		pointformat = srchdr.PointDataRecordFormat
+		if lasformat == 1.2:
+			# formats 0-3 by whether they have gps time and colour
+			pointformat = [0, 1, 2, 3, 1, 3, 1, 3, 3, 1, 3][pointformat]
+	if lasformat == 1.2 and pointformat > 3:
+		raise ValueError("las 1.2 only supports point formats 0-3")
+
+	geotiffids = (34735, 34736, 34737)
+	crsids = [vlr.recordid for vlr in reader.vlrs + reader.evlrs if vlr.userid == b'LASF_Projection']
+	usewkt = pointformat >= 6 or wkt is not None or (2112 in crsids and not any([recordid in geotiffids for recordid in crsids]))
+	exclude = []
+	if usewkt:
+		if wkt is None and 2112 not in crsids and any([recordid in geotiffids for recordid in crsids]):
+			reader.close()
+			raise ValueError("point format %d needs the coordinate system in WKT, but %s only has GeoTIFF keys.  pass the WKT with wkt=" % (pointformat, infilename))
+		exclude = [(b'LASF_Projection', recordid) for recordid in geotiffids]
+		if wkt is not None:
+			exclude.append((b'LASF_Projection', 2112))
+
+	writer = laswriter(outfilename, lasformat)
+	writer.copyheader(reader, exclude)
+	if wkt is not None:
+		writer.writeVLR(b'LASF_Projection', 2112, b'OGC Coordinate System WKT', wkt.encode('utf-8') + b'\0')
+	extrabytes = srchdr.PointDataRecordLength - srchdr.getsuportedpointformats()[srchdr.PointDataRecordFormat][1]
+	writer.hdr.PointDataRecordFormat = pointformat
+	writer.hdr.PointDataRecordLength += extrabytes
+	if lasformat == 1.2:
+		# las 1.2 only defines the gps time type bit
+		writer.hdr.GlobalEncoding &= 1
+	elif usewkt:
+		# the WKT bit says the coordinate system is in WKT rather than GeoTIFF keys
+		writer.hdr.GlobalEncoding |= 0x10
+	else:
+		writer.hdr.GlobalEncoding &= ~0x10
+
+	for data in reader.iter_pointbytes(chunk_size, 0):
+		writer.writepointbytes(convertpointrecords(data, srchdr, writer.hdr))
+	reader.close()
+	writer.close()
+
+###############################################################################
+def tilelasfile(infilename, outfolder, tilesize=1000.0, maxopen=64, buffersize=65536, maxbuffered=2000000, chunk_size=1000000):
+	'''
+	split a las or laz file into square tiles tilesize wide, in one pass, and return the names of the tile files.  the tiles are named after the file and the lower left corner of the tile, eg strip_300000_6001000.las, or strip_147.5_-42.5.las for tiles smaller than a unit.
+	each chunk of records is routed into a buffer for each tile, and a tile's buffer is written when it holds buffersize records, or the biggest buffers are written when all of them hold more than maxbuffered records.  the tile writers are kept in a least recently used pool of at most maxopen open files.  the others are suspended, see laswriter.suspend(), so we can write thousands of tiles without running out of file handles.
+	the records are copied byte for byte, and every tile header is finalised at the end
+	'''
+	reader = lasreader(infilename)
+	reader.readhdr()
+	hdr = reader.hdr
+	recordlength = hdr.getpointstruct().size
+	base, extension = os.path.splitext(os.path.basename(infilename))
+	if not os.path.isdir(outfolder):
+		os.makedirs(outfolder)
+
+	writers = {}
+	# the tiles whose writer has an open file, least recently used first
+	openwriters = collections.OrderedDict()
+	buffers = collections.defaultdict(bytearray)
+	filenames = set()
+
+	def flushtile(tile):
+		writer = writers.get(tile)
+		if writer is None or writer.suspended:
+			while len(openwriters) >= maxopen:
+				oldest, w = openwriters.popitem(last=False)
+				w.suspend()
+		if writer is None:
+			# 15 significant digits keep fractional corners apart without showing the rounding error of the multiplication
+			filename = os.path.join(outfolder, "%s_%.15g_%.15g%s" % (base, tile[0] * tilesize, tile[1] * tilesize, extension))
+			if filename in filenames:
+				raise ValueError("two tiles would both be written to %s, use a bigger tile size" % (filename))
+			filenames.add(filename)
+			writer = laswriter(filename, hdr.lasformat, workers=1, variablechunks=True)
+			writer.copyheader(reader)
+			writers[tile] = writer
+		writer.writepointbytes(buffers.pop(tile))
+		openwriters[tile] = writer
+		openwriters.move_to_end(tile)
+
+	for data in reader.iter_pointbytes(chunk_size, 0):
+		columns = reader.decodefields(data, ["x", "y"])
+		tiles = collections.defaultdict(list)
+		for i, (x, y) in enumerate(zip(columns["x"], columns["y"])):
+			tiles[(math.floor(x / tilesize), math.floor(y / tilesize))].append(i)
+		for tile, indices in tiles.items():
+			buffers[tile] += selectrecords(data, recordlength, indices)
+			if len(buffers[tile]) >= buffersize * recordlength:
+				flushtile(tile)
+		# keep the memory fixed however many tiles there are
+		buffered = sum([len(b) for b in buffers.values()])
+		if buffered > maxbuffered * recordlength:
+			for tile in sorted(buffers.keys(), key=lambda t: len(buffers[t]), reverse=True):
+				buffered -= len(buffers[tile])
+				flushtile(tile)
+				if buffered <= maxbuffered * recordlength // 2:
+					break
+
+	for tile in list(buffers.keys()):
+		flushtile(tile)
+	# close the open writers first, so we never have more than maxopen files open
+	for tile in list(openwriters.keys()):
+		openwriters.pop(tile).close()
+	for writer in writers.values():
+		if writer.suspended:
+			writer.close()
+	reader.close()
+	return sorted([writer.fileName for writer in writers.values()])
 
+###############################################################################
+def thinlasfile(infilename, outfilename, voxelsize, mode="first", chunk_size=1000000):
+	'''
+	thin a las file to one point per voxel, a cube voxelsize wide, and write the kept points to a new las or laz file.
+	mode chooses the point we keep: 'first' in the file, 'centre' nearest the centre of the voxel, or 'lowest' z.
+	the file is streamed in chunks.  the voxels are keyed on a single integer, so memory is set by the number of occupied voxels, not the number of points.
+	'first' needs one pass.  the other modes find the best point of every voxel in a first pass, then copy those records in a second pass.  the records are copied byte for byte, so the output is in the same order as the input
+	'''
+	if mode not in ("first", "centre", "lowest"):
+		raise ValueError("mode must be 'first', 'centre' or 'lowest'")
+	reader = lasreader(infilename)
+	reader.readhdr()
+	hdr = reader.hdr
+	recordlength = hdr.getpointstruct().size
+	writer = laswriter(outfilename, hdr.lasformat)
+	writer.copyheader(reader)
+
+	# work in raw integer coordinates so we never scale the points
+	x0 = math.floor((hdr.MinX - hdr.Xoffset) / hdr.Xscalefactor)
+	y0 = math.floor((hdr.MinY - hdr.Yoffset) / hdr.Yscalefactor)
+	z0 = math.floor((hdr.MinZ - hdr.Zoffset) / hdr.Zscalefactor)
+	vx = voxelsize / hdr.Xscalefactor
+	vy = voxelsize / hdr.Yscalefactor
+	vz = voxelsize / hdr.Zscalefactor
+	ny = int(math.ceil((hdr.MaxY - hdr.MinY) / voxelsize)) + 2
+	nz = int(math.ceil((hdr.MaxZ - hdr.MinZ) / voxelsize)) + 2
+
+	# pass 1, find the point to keep in each voxel.  in 'first' mode we can write it straight away
+	voxels = {}
+	first = 0
+	for data in reader.iter_pointbytes(chunk_size, 0):
+		count = len(data) // recordlength
+		columns = reader.decodefields(data, ["x", "y", "z"], scaled=False)
+		keep = []
+		for i, (x, y, z) in enumerate(zip(columns["x"], columns["y"], columns["z"])):
+			fx = (x - x0) / vx
+			fy = (y - y0) / vy
+			fz = (z - z0) / vz
+			kx = math.floor(fx)
+			ky = math.floor(fy)
+			kz = math.floor(fz)
+			key = ((kx * ny) + ky) * nz + kz
+			if mode == "first":
+				if key not in voxels:
+					voxels[key] = None
+					keep.append(i)
+				continue
+			if mode == "centre":
+				score = (fx - kx - 0.5) ** 2 + (fy - ky - 0.5) ** 2 + (fz - kz - 0.5) ** 2
+			else:
+				score = z
+			best = voxels.get(key)
+			if best is None or score < best[0]:
+				voxels[key] = (score, first + i)
+		if mode == "first":
+			writer.writepointbytes(selectrecords(data, recordlength, keep))
+		first += count
+
+	# pass 2, copy the records we kept, in file order
+	if mode != "first":
+		kept = sorted([index for score, index in voxels.values()])
+		voxels = None
+		first = 0
+		j = 0
+		for data in reader.iter_pointbytes(chunk_size, 0):
+			if j == len(kept):
+				break
+			count = len(data) // recordlength
+			k = bisect.bisect_left(kept, first + count, j)
+			writer.writepointbytes(selectrecords(data, recordlength, [index - first for index in kept[j:k]]))
+			j = k
+			first += count
+
+	reader.close()
+	writer.close()
+
+def sortlasfile(infilename, outfilename, curve="morton", chunk_size=1000000, tempfolder=None, maxfanin=64, mergememory=256 * 1024 * 1024):
+	'''
+	rewrite a las file with its points reordered along a space filling curve ('morton' or 'hilbert'), so points close in space are close in the file.
+	this is an external memory sort, so it works on files much larger than memory.  each chunk of raw records is sorted and written to a temporary run file, then the runs are merged into the output.
+	at most maxfanin runs are open at once.  if there are more, groups of runs are merged into longer runs first, in as many passes as it takes.  each open run gets an equal share of mergememory bytes of read buffer.
+	the records are copied byte for byte, and the header, VLRs and anything after the point block are copied unchanged
+	'''
+	reader = lasreader(infilename)
+	reader.readhdr()
+	hdr = reader.hdr
+	if hdr.compressed:
+		raise ValueError("sortlasfile copies the point records byte for byte, so it cannot sort a LAZ file")
+	recordlength = hdr.getpointstruct().size
+
+	# the curve covers the bounding box in raw integer coordinates, as the keys are computed from the raw records
+	rawminx = math.floor((hdr.MinX - hdr.Xoffset) / hdr.Xscalefactor)
+	rawminy = math.floor((hdr.MinY - hdr.Yoffset) / hdr.Yscalefactor)
+	rawmaxx = math.ceil((hdr.MaxX - hdr.Xoffset) / hdr.Xscalefactor)
+	rawmaxy = math.ceil((hdr.MaxY - hdr.Yoffset) / hdr.Yscalefactor)
+	cellsize = curvecellsize(rawminx, rawminy, rawmaxx, rawmaxy, curve)
+	keystruct = struct.Struct("<Q")
+
+	with tempfile.TemporaryDirectory(dir=tempfolder) as folder:
+		# pass 1, write sorted runs of key + record
+		runs = []
+		for data in reader.iter_pointbytes(chunk_size, 0):
+			count = len(data) // recordlength
+			columns = reader.decodefields(data, ["x", "y"], scaled=False)
+			keys = curvekeys(columns["x"], columns["y"], rawminx, rawminy, cellsize, curve)
+			order = sorted(range(count), key=keys.__getitem__)
+			runname = os.path.join(folder, "run%d.tmp" % (len(runs)))
+			with open(runname, 'wb') as run:
+				run.write(b"".join([keystruct.pack(keys[i]) + data[i * recordlength:(i + 1) * recordlength] for i in order]))
+			runs.append(runname)
+
+		# merge groups of runs into longer runs until they can all be merged at once, so we never run out of file handles
+		maxfanin = max(2, maxfanin)
+		passnumber = 0
+		while len(runs) > maxfanin:
+			merged = []
+			for i in range(0, len(runs), maxfanin):
+				runname = os.path.join(folder, "run%d_%d.tmp" % (passnumber, len(merged)))
+				with open(runname, 'wb') as run:
+					mergesortruns(runs[i:i + maxfanin], run, recordlength, mergememory, True)
+				for name in runs[i:i + maxfanin]:
+					os.remove(name)
+				merged.append(runname)
+			runs = merged
+			passnumber += 1
+
+		# the final pass merges the runs into the output file
+		with open(outfilename, 'wb') as out:
+			reader.rewind()
+			out.write(reader.read(hdr.Offsettopointdata))
+			mergesortruns(runs, out, recordlength, mergememory, False)
+
+			# copy any extended VLRs or waveform data after the point block.  the point block is the same size, so their offsets are still correct
+			reader.seekPointRecordEnd()
+			while True:
+				data = reader.read(1024 * 1024 * 16)
+				if len(data) == 0:
+					break
+				out.write(data)
+	reader.close()
+
+def mergesortruns(runnames, out, recordlength, mergememory, keepkeys):
+	'''
+	merge sorted run files written by sortlasfile into the open file out.  if keepkeys is True the keys are written too, so the output is itself a run
+	'''
+	itemlength = 8 + recordlength
+	# share the read buffer memory between the runs, and allow as much again for the output buffer
+	blocksize = max(1, mergememory // (len(runnames) * itemlength))
+	keystruct = struct.Struct("<Q")
+	buf = bytearray()
+	for key, record in heapq.merge(*[readsortrun(runname, recordlength, blocksize) for runname in runnames]):
+		if keepkeys:
+			buf += keystruct.pack(key)
+		buf += record
+		if len(buf) >= mergememory:
+			out.write(buf)
+			buf = bytearray()
+	out.write(buf)
+
+def readsortrun(filename, recordlength, blocksize=65536):
+	'''
+	generator which yields the (key, record) pairs from a sorted run file written by sortlasfile, reading a block of records at a time
+	'''
+	itemlength = 8 + recordlength
+	keystruct = struct.Struct("<Q")
+	with open(filename, 'rb') as f:
+		while True:
+			data = f.read(itemlength * blocksize)
+			if len(data) == 0:
+				return
+			for i in range(0, len(data), itemlength):
+				yield (keystruct.unpack_from(data, i)[0], data[i + 8:i + itemlength])
 
 ###############################################################################
 def createOutputFileName(path):
@@ -1487,9 +3287,10 @@ def testreader(filename):
 	# print some metadata about the reader
 	print (r.hdr)
 
-	# read the variable records
-	for i in range(r.hdr.NumberofVariableLengthRecords):
-		r.readvariablelengthrecord()
+	# list the variable records.  the payloads are only read when we ask for them
+	for vlr in r.vlrs:
+		print (vlr)
+	print (r.get_vlr('LASF_Projection', 2112))
 
 	# now find the start point for the point records
 	r.seekPointRecordStart()